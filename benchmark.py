@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+   benchmark.py - Measure the speed of getmyancestors components
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# global import
+import os
+import sys
+import time
+import re
+import random
+import json
+import argparse
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+
+# local import
+from getmyancestors import Tree, cont
+from mergemyancestors import Gedcom
+import fsserver
+
+# words of life sketches and memories in several scripts
+WORDS = {
+    'English': 'Born in a small village, this person spent most of a long life there, working the land and raising a large family.',
+    'French': 'Née dans un petit village, elle y a passé presque toute sa vie, à travailler la terre et à élever une grande famille.',
+    'Russian': 'Родился в маленькой деревне, провёл там почти всю свою долгую жизнь, работал на земле и вырастил большую семью.',
+    'Greek': 'Γεννήθηκε σε ένα μικρό χωριό, έζησε εκεί σχεδόν όλη τη μακρά ζωή του και μεγάλωσε μια μεγάλη οικογένεια.',
+    'Chinese': '出生于一个小村庄， 一生大部分时间都在那里度过， 耕种土地， 抚养了一个大家庭。',
+    'Japanese': '小さな村で生まれ、 長い生涯のほとんどをそこで過ごし、 土地を耕し、 大家族を育てた。',
+    'Emoji': 'Family reunion 1987 👨‍👩‍👧‍👦 🎂 🌳 with grandparents 👴👵 and cousins from abroad ✈️',
+}
+
+SKETCH = 'Born in a small village, this person spent most of a long life there, working the land and raising a large family. Parish registers, census returns and a family bible all mention the household. '
+
+
+# write a synthetic GEDCOM file shaped like the output of getmyancestors.py: a pedigree of persons
+def write_gedcom(file, persons):
+    file.write('0 HEAD\n1 CHAR UTF-8\n1 GEDC\n2 VERS 5.5\n2 FORM LINEAGE-LINKED\n')
+    for i in range(1, persons + 1):
+        file.write('0 @I%d@ INDI\n1 NAME Given%d /Surname%d/\n1 SEX %s\n' % (i, i, i % 1000, 'MF'[i % 2]))
+        file.write('1 BIRT\n2 DATE %d March %d\n2 PLAC Paris, Île-de-France, France\n3 MAP\n4 LATI 48.8566\n4 LONG 2.3522\n2 NOTE @N%d@\n' % (1 + i % 28, 2000 - i % 300, 2 * i))
+        file.write('1 DEAT\n2 DATE %d\n2 PLAC Paris, Île-de-France, France\n' % (2070 - i % 300))
+        if 2 * i + 1 <= persons:
+            file.write('1 FAMC @F%d@\n' % i)
+        if 1 < i and 2 * (i // 2) + 1 <= persons:
+            file.write('1 FAMS @F%d@\n' % (i // 2))
+        file.write('1 _FSFTID L%03d-%03d\n1 NOTE @N%d@\n' % (i // 1000, i % 1000, 2 * i + 1))
+        file.write('1 SOUR @S%d@\n2 PAGE Census record for Given%d\n' % (1 + i % 100, i))
+    for i in range(1, (persons - 1) // 2 + 1):
+        file.write('0 @F%d@ FAM\n1 HUSB @I%d@\n1 WIFE @I%d@\n1 CHIL @I%d@\n' % (i, 2 * i, 2 * i + 1, i))
+    for i in range(1, 101):
+        file.write('0 @S%d@ SOUR \n1 TITL Census %d\n1 REFN S000-%03d\n' % (i, 1850 + i, i))
+    for i in range(1, persons + 1):
+        file.write(cont('0 @N%d@ NOTE From the %d census' % (2 * i, 1900 + i % 100)) + '\n')
+        file.write(cont('0 @N%d@ NOTE === Life Sketch ===\n' % (2 * i + 1) + SKETCH * 3) + '\n')
+    file.write('0 TRLR\n')
+
+
+# GEDCOM line wrapping as written before it was optimized, to check the output of cont
+def reference_cont(string):
+    level = int(string[:1]) + 1
+    lines = string.splitlines()
+    res = list()
+    max_len = 255
+    for line in lines:
+        c_line = line
+        to_conc = list()
+        while len(c_line.encode('utf-8')) > max_len:
+            index = min(max_len, len(c_line) - 2)
+            while (len(c_line[:index].encode('utf-8')) > max_len or re.search(r'[ \t\v]', c_line[index - 1:index + 1])) and index > 1:
+                index -= 1
+            to_conc.append(c_line[:index])
+            c_line = c_line[index:]
+            max_len = 248
+        to_conc.append(c_line)
+        res.append(('\n%s CONC ' % level).join(to_conc))
+        max_len = 248
+    return ('\n%s CONT ' % level).join(res)
+
+
+# random notes of some paragraphs of sentences in the languages of WORDS, and a few long URLs and runs of spaces
+def texts(number, seed=0):
+    rng = random.Random(seed)
+    res = list()
+    for _ in range(number):
+        paragraphs = list()
+        for _ in range(rng.randint(1, 4)):
+            paragraphs.append(' '.join(rng.choice(list(WORDS.values())) for _ in range(rng.randint(1, 12))))
+        if rng.random() < 0.2:
+            paragraphs.append('https://www.familysearch.org/photos/artifacts/' + 'x' * rng.randint(200, 600))
+        if rng.random() < 0.2:
+            paragraphs.append(' ' * rng.randint(1, 300) + 'Family bible' + '\t' * rng.randint(1, 10))
+        res.append('0 @N%d@ NOTE === Life Sketch ===\n' % len(res) + '\n'.join(paragraphs))
+    return res
+
+
+# wrap the lines of notes with cont and check the output against reference_cont
+def wrap(args):
+    notes = texts(args.n)
+    size = sum(len(note.encode('utf-8')) for note in notes)
+    for name, function in (('reference_cont', reference_cont), ('cont', cont)):
+        start = time.perf_counter()
+        for _ in range(args.r):
+            output = [function(note) for note in notes]
+        elapsed = (time.perf_counter() - start) / args.r
+        if function is reference_cont:
+            expected = output
+        elif output != expected:
+            sys.exit('cont and reference_cont differ')
+        print('%s: %d notes, %.1f MB in %.3f seconds: %.1f MB/s' % (name, len(notes), size / 2 ** 20, elapsed, size / 2 ** 20 / elapsed))
+
+
+# parse a GEDCOM file with mergemyancestors.Gedcom
+def gedcom(args):
+    path = args.i
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.ged')
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            write_gedcom(file, args.n)
+    try:
+        with open(path, 'rb') as file:
+            lines = sum(block.count(b'\n') for block in iter(lambda: file.read(2 ** 20), b''))
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        with open(path, encoding='utf-8') as file:
+            ged = Gedcom(file, Tree())
+        elapsed = time.perf_counter() - start
+    finally:
+        if not args.i:
+            os.remove(path)
+    print('Parsed %s individuals, %s families and %s notes' % (len(ged.indi), len(ged.fam), len(ged.note)))
+    print('%s lines, %.1f MB in %.2f seconds: %d lines/s, %.1f MB/s' % (lines, size / 2 ** 20, elapsed, lines / elapsed, size / 2 ** 20 / elapsed))
+
+
+# memory used by the records of a synthetic GEDCOM file parsed with mergemyancestors.Gedcom
+def memory(args):
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as file:
+        write_gedcom(file, args.n)
+        file.seek(0)
+        tracemalloc.start()
+        ged = Gedcom(file, Tree())
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    print('%d individuals, %d families and %d notes in %.1f MB: %d bytes per individual' % (len(ged.indi), len(ged.fam), len(ged.note), size / 2 ** 20, size / len(ged.indi)))
+
+
+# crawl a synthetic tree served by fsserver.py with getmyancestors.py, once for each number of workers
+def crawl(args):
+    server = fsserver.Server(('127.0.0.1', 0), fsserver.SyntheticTree(args.n, args.b, args.s, args.g), latency=args.L, errors=args.e, slow=args.S)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s' % server.server_address[1]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'getmyancestors.py')
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        for workers in args.w:
+            command = [sys.executable, script, '-u', 'benchmark', '-p', server.password, '--server', url, '--rate', str(args.rate),
+                       '--workers', str(workers), '-t', str(args.t), '-a', str(args.a), '-d', str(args.d), '--metrics-out', path, '-o', os.devnull]
+            start = time.perf_counter()
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            # wait4 gives the peak resident set size of this run only, in kB on Linux
+            status, usage = os.wait4(process.pid, 0)[1:]
+            process.returncode = os.waitstatus_to_exitcode(status)
+            elapsed = time.perf_counter() - start
+            if process.returncode:
+                sys.exit('getmyancestors.py failed with %s workers: %s' % (workers, ' '.join(command)))
+            with open(path, encoding='utf-8') as file:
+                requests = json.load(file)['requests']
+            print('%d workers: %d requests in %.2f seconds: %.1f requests/s, %.1f MB peak RSS' % (workers, requests, elapsed, requests / elapsed, usage.ru_maxrss / 2 ** 10))
+    finally:
+        os.remove(path)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the speed of getmyancestors components', usage='benchmark.py <command> [options]')
+    commands = parser.add_subparsers(dest='command', metavar='<command>')
+    command = commands.add_parser('gedcom', help='Parse a GEDCOM file with mergemyancestors.py')
+    command.add_argument('-i', metavar='<FILE>', type=str, help='GEDCOM file to parse [synthetic file]')
+    command.add_argument('-n', metavar='<INT>', type=int, default=100000, help='Number of individuals of the synthetic file [100000]')
+    command.set_defaults(run=gedcom)
+    command = commands.add_parser('cont', help='Wrap long multilingual notes with cont')
+    command.add_argument('-n', metavar='<INT>', type=int, default=2000, help='Number of notes [2000]')
+    command.add_argument('-r', metavar='<INT>', type=int, default=3, help='Number of repetitions [3]')
+    command.set_defaults(run=wrap)
+    command = commands.add_parser('memory', help='Measure the memory used by the records of a GEDCOM file')
+    command.add_argument('-n', metavar='<INT>', type=int, default=100000, help='Number of individuals of the synthetic file [100000]')
+    command.set_defaults(run=memory)
+    command = commands.add_parser('crawl', help='Crawl a synthetic tree served by fsserver.py with getmyancestors.py')
+    command.add_argument('-n', metavar='<INT>', type=int, default=1000, help='Number of individuals in the synthetic tree [1000]')
+    command.add_argument('-b', metavar='<INT>', type=int, default=3, help='Number of children per couple [3]')
+    command.add_argument('-s', metavar='<INT>', type=int, default=0, help='Random seed of the synthetic tree [0]')
+    command.add_argument('-a', metavar='<INT>', type=int, default=12, help='Number of generations to ascend [12]')
+    command.add_argument('-d', metavar='<INT>', type=int, default=1, help='Number of generations to descend [1]')
+    command.add_argument('-L', metavar='<FLOAT>', type=float, default=0.02, help='Mean latency of API requests in seconds [0.02]')
+    command.add_argument('-e', metavar='<FLOAT>', type=float, default=0, help='Fraction of API requests failing with 429 or 503 [0]')
+    command.add_argument('-S', metavar='<FLOAT>', type=float, default=0, help='Latency of persons.json requests per person in seconds [0]')
+    command.add_argument('-g', metavar='<FLOAT>', type=float, default=0, help='Fraction of deleted persons, whose persons.json requests fail with 410 [0]')
+    command.add_argument('-t', metavar='<INT>', type=int, default=60, help='Timeout of the requests in seconds [60]')
+    command.add_argument('-w', metavar='<INT>', type=int, nargs='+', default=[1, 4, 8, 16], help='Numbers of concurrent HTTP requests to compare [1 4 8 16]')
+    command.add_argument('--rate', metavar='<FLOAT>', type=float, default=0, help='Maximum number of requests per second, 0 for no limit [0]')
+    command.set_defaults(run=crawl)
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        exit(2)
+    args.run(args)
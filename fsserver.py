@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+   fsserver.py - Local FamilySearch stand-in server for testing and benchmarking
+
+   Serves a synthetic family tree through the part of the FamilySearch API
+   used by getmyancestors.py, run it with --server http://127.0.0.1:<PORT>
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# global import
+from __future__ import print_function
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GIVEN = {
+    'M': ['John', 'Pierre', 'Giulio', 'Иван', 'José', 'Wei', 'Hans', 'Kenji', 'Ahmed', 'Lars'],
+    'F': ['Mary', 'Marie', 'Giulia', 'Анна', 'María', 'Mei', 'Greta', 'Yuki', 'Fatima', 'Ingrid'],
+}
+SURNAMES = ['Smith', 'Martin', 'Rossi', 'Иванов', 'García', 'Wang', 'Müller', 'Tanaka', 'Haddad', 'Larsen']
+PLACES = [
+    ('Paris, Île-de-France, France', 48.8566, 2.3522),
+    ('Roma, Lazio, Italia', 41.9028, 12.4964),
+    ('Boston, Massachusetts, United States', 42.3601, -71.0589),
+    ('Москва, Россия', 55.7558, 37.6173),
+    ('Sevilla, Andalucía, España', 37.3891, -5.9845),
+    ('北京市, 中国', 39.9042, 116.4074),
+    ('München, Bayern, Deutschland', 48.1351, 11.5820),
+    ('大阪市, 日本', 34.6937, 135.5023),
+]
+SKETCH = ('{0} was born in {1} and spent most of a long life there, working the land and raising a large family. '
+          'Parish registers, census returns and a family bible all mention the household. ') * 6
+
+
+def fsid(n):
+    digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    s = ''
+    for _ in range(7):
+        n, r = divmod(n, 36)
+        s = digits[r] + s
+    return 'L' + s[1:4] + '-' + s[4:]
+
+
+# synthetic pedigree with siblings and descendants of the root person
+class SyntheticTree:
+    def __init__(self, size=1000, branching=3, seed=0, deleted=0, changed=0):
+        self.random = random.Random(seed)
+        self.persons = dict()
+        self.parents = dict()
+        self.couples = dict()
+        self.child_rels = list()
+        self.sources = dict()
+        for i in range(max(10, size // 20)):
+            self.sources['S%03d-%03d' % (i // 1000, i % 1000)] = {
+                'id': 'S%03d-%03d' % (i // 1000, i % 1000),
+                'about': 'https://familysearch.org/ark:/61903/1:1:%05d' % i,
+                'titles': [{'value': 'Census %d, district %d' % (1850 + 10 * (i % 8), i)}],
+                'citations': [{'value': '"Census," database, FamilySearch; citing district %d, sheet %d.' % (i, i * 7)}],
+            }
+        self.root = self.new_person('M', 1950)
+        todo = [self.root]
+        spouse = self.new_person('F', 1952)
+        for _ in range(branching):
+            self.new_child(self.root, spouse, 1980)
+        while todo and len(self.persons) < size:
+            child = todo.pop(0)
+            year = self.persons[child]['year'] - 28
+            father = self.new_person('M', year)
+            mother = self.new_person('F', year + 2)
+            self.link(father, mother, child)
+            for _ in range(branching - 1):
+                if len(self.persons) >= size:
+                    break
+                self.new_child(father, mother, year + 25)
+            todo += [father, mother]
+        # deleted persons, still referenced by their relatives, whose batches fail
+        self.deleted = set(self.random.sample(sorted(self.persons)[1:], int(deleted * len(self.persons)))) if deleted else set()
+        # persons and couples modified when the tree is created, so after a crawl of a previous server, by id
+        self.modified = dict()
+        if changed:
+            ids = sorted(self.persons) + sorted(rel['id'] for rel in self.couples.values())
+            now = int(time.time() * 1000)
+            self.modified = {fid: now for fid in self.random.sample(ids, int(changed * len(ids)))}
+        self.couple_ids = {rel['id']: rel for rel in self.couples.values()}
+        self.rels = dict()
+        for rel in self.couples.values():
+            for fid in (rel['person1'], rel['person2']):
+                self.rels.setdefault(fid, list()).append(rel)
+        self.crels = dict()
+        for rel in self.child_rels:
+            for fid in (rel['father'], rel['mother'], rel['child']):
+                self.crels.setdefault(fid, list()).append(rel)
+
+    def new_person(self, gender, year):
+        fid = fsid(len(self.persons) + 1)
+        self.persons[fid] = {'id': fid, 'gender': gender, 'year': year,
+                             'given': self.random.choice(GIVEN[gender]), 'surname': self.random.choice(SURNAMES),
+                             'place': self.random.randrange(len(PLACES)),
+                             'sources': self.random.sample(sorted(self.sources), self.random.randint(0, 4)),
+                             'memories': self.random.random() < 0.3}
+        return fid
+
+    def new_child(self, father, mother, year):
+        child = self.new_person(self.random.choice('MF'), year)
+        self.link(father, mother, child)
+        return child
+
+    def link(self, father, mother, child):
+        if (father, mother) not in self.couples:
+            self.couples[(father, mother)] = {'id': 'C%06d' % len(self.couples), 'person1': father, 'person2': mother}
+        self.child_rels.append({'id': 'R%06d' % len(self.child_rels), 'father': father, 'mother': mother, 'child': child})
+
+    def person(self, fid):
+        p = self.persons[fid]
+        place, latitude, longitude = PLACES[p['place']]
+        data = {
+            'id': fid,
+            'names': [{'preferred': True, 'type': 'http://gedcomx.org/BirthName', 'attribution': {},
+                       'nameForms': [{'fullText': '%s %s' % (p['given'], p['surname']),
+                                      'parts': [{'type': 'http://gedcomx.org/Given', 'value': p['given']},
+                                                {'type': 'http://gedcomx.org/Surname', 'value': p['surname']}]}]}],
+            'gender': {'type': 'http://gedcomx.org/Male' if p['gender'] == 'M' else 'http://gedcomx.org/Female'},
+            'facts': [
+                {'type': 'http://gedcomx.org/Birth', 'date': {'original': '%d March %d' % (1 + p['year'] % 28, p['year'])},
+                 'place': {'original': place, 'description': '#P%d' % p['place']},
+                 'attribution': {'changeMessage': 'From the %d census' % (p['year'] - p['year'] % 10 + 10)}},
+                {'type': 'http://gedcomx.org/Death', 'date': {'original': str(p['year'] + 70)},
+                 'place': {'original': place, 'description': '#P%d' % p['place']}, 'attribution': {}},
+                {'type': 'http://familysearch.org/v1/LifeSketch', 'value': SKETCH.format(p['given'], place), 'attribution': {}},
+            ],
+            'attribution': {'modified': self.modified.get(fid, 1500000000000)},
+        }
+        if p['sources']:
+            data['sources'] = [{'descriptionId': s, 'description': '#' + s, 'attribution': {'changeMessage': 'Census record for ' + p['given']}}
+                               for s in p['sources']]
+        if p['memories']:
+            data['evidence'] = [{'id': 'M' + fid}]
+        return data
+
+    def place(self, n):
+        name, latitude, longitude = PLACES[n]
+        return {'id': 'P%d' % n, 'latitude': latitude, 'longitude': longitude, 'names': [{'value': name}]}
+
+    def persons_batch(self, fids):
+        fids = [fid for fid in fids if fid in self.persons]
+        if not fids:
+            return None
+        wanted = set(fids)
+        data = {'persons': [self.person(fid) for fid in fids], 'childAndParentsRelationships': [], 'relationships': []}
+        crels = {rel['id']: rel for fid in fids for rel in self.crels.get(fid, [])}
+        for rel in crels.values():
+            data['childAndParentsRelationships'].append({
+                'id': rel['id'], 'father': {'resourceId': rel['father']}, 'mother': {'resourceId': rel['mother']},
+                'child': {'resourceId': rel['child']}})
+        rels = {rel['id']: rel for fid in fids for rel in self.rels.get(fid, [])}
+        for rel in rels.values():
+            data['relationships'].append({
+                'id': rel['id'], 'type': 'http://gedcomx.org/Couple', 'attribution': {'modified': self.modified.get(rel['id'], 1500000000000)},
+                'person1': {'resourceId': rel['person1']}, 'person2': {'resourceId': rel['person2']}})
+        data['places'] = [self.place(n) for n in sorted({self.persons[fid]['place'] for fid in wanted})]
+        return data
+
+    def person_sources(self, fid):
+        p = self.persons[fid]
+        return {'persons': [{'sources': [{'descriptionId': s, 'attribution': {'changeMessage': 'Census record for ' + p['given']}}
+                                         for s in p['sources']]}],
+                'sourceDescriptions': [self.sources[s] for s in p['sources']]}
+
+    def person_memories(self, fid):
+        p = self.persons[fid]
+        return {'sourceDescriptions': [
+            {'mediaType': 'image/jpeg', 'about': 'https://familysearch.org/photos/artifacts/%s' % fid, 'links': {},
+             'titles': [{'value': 'Portrait of %s %s' % (p['given'], p['surname'])}]},
+            {'mediaType': 'text/plain', 'titles': [{'value': 'Story'}],
+             'descriptions': [{'value': 'A story about %s, told by a grandchild.' % p['given']}]}]}
+
+    def person_notes(self, fid):
+        p = self.persons[fid]
+        return {'persons': [{'notes': [{'subject': 'Research', 'text': 'Check the parish register of %s.' % PLACES[p['place']][0]}]}]}
+
+    def changes(self, fid):
+        n = int(hashlib.md5(fid.encode()).hexdigest(), 16)
+        return {'entries': [{'contributors': [{'name': 'contributor%d' % ((n >> i) % 5)}]} for i in range(3)]}
+
+    def ordinances(self, fid):
+        return {'persons': [{'ordinances': [
+            {'type': 'http://lds.org/Baptism', 'status': 'http://familysearch.org/v1/Completed',
+             'date': {'formal': '+1990-01-01'}, 'templeCode': 'SLAKE'}]}]}
+
+    def couple(self, relfid):
+        if relfid not in self.couple_ids:
+            return None
+        return {'relationships': [{'facts': [
+            {'type': 'http://gedcomx.org/Marriage', 'date': {'original': '1900'}, 'attribution': {}}],
+            'sources': [{'descriptionId': s, 'attribution': {}} for s in sorted(self.sources)[:2]]}]}
+
+    def couple_sources(self, relfid):
+        return {'sourceDescriptions': [self.sources[s] for s in sorted(self.sources)[:2]]}
+
+    def couple_notes(self, relfid):
+        return {'relationships': [{'notes': [{'subject': 'Marriage', 'text': 'Banns published three times.'}]}]}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, data):
+        if data is None:
+            return self.reply(404, b'{"errors": [{"message": "Not found"}]}')
+        body = json.dumps(data).encode('utf-8')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, headers={'ETag': etag})
+        self.reply(200, body, {'Content-Type': 'application/json', 'ETag': etag})
+
+    def base(self):
+        return 'http://%s' % self.headers.get('Host')
+
+    def authorized(self):
+        cookie = self.headers.get('Cookie') or ''
+        for part in cookie.split(';'):
+            key, _, value = part.strip().partition('=')
+            if key == 'fssessionid':
+                return self.server.check_session(value)
+        return False
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        server.count('login')
+        if urlsplit(self.path).path != '/cis-web/oauth2/v3/authorization':
+            return self.reply(404)
+        if form.get('password', [''])[0] != server.password:
+            return self.reply(200, b'<html>The username or password was incorrect</html>')
+        self.reply(302, headers={'Location': self.base() + '/auth/familysearch/callback?code=ok'})
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        path = url.path
+        if path == '/auth/familysearch/login':
+            server.count('login')
+            return self.reply(302, headers={'Location': self.base() + '/cis-web/oauth2/v3/authorization/form'})
+        if path == '/cis-web/oauth2/v3/authorization/form':
+            server.count('login')
+            return self.reply(200, b'<form><input type="hidden" name="params" value="abc123"/></form>')
+        if path == '/auth/familysearch/callback':
+            server.count('login')
+            return self.reply(200, headers={'Set-Cookie': 'fssessionid=%s; Path=/' % server.new_session()})
+        server.count('api')
+        if server.latency:
+            time.sleep(server.random.expovariate(1 / server.latency))
+        if not self.authorized():
+            return self.reply(401, b'{"errors": [{"message": "Unauthorized"}]}')
+        if server.errors and server.random.random() < server.errors:
+            if server.random.random() < 0.5:
+                return self.reply(429, b'', {'Retry-After': '1'})
+            return self.reply(503, b'')
+        tree = server.tree
+        parts = path.split('/')
+        if path == '/platform/users/current.json':
+            return self.reply_json({'users': [{'personId': tree.root, 'preferredLanguage': 'en'}]})
+        if path == '/platform/tree/persons.json':
+            fids = parse_qs(url.query).get('pids', [''])[0].split(',')
+            if server.slow:
+                time.sleep(server.slow * len(fids))
+            if tree.deleted.intersection(fids):
+                return self.reply(410, b'{"errors": [{"message": "Gone"}]}')
+            return self.reply_json(tree.persons_batch(fids))
+        if path.startswith('/platform/tree/persons/'):
+            fid = parts[4].split('.')[0]
+            if fid not in tree.persons:
+                return self.reply_json(None)
+            if len(parts) == 5:
+                return self.reply_json(tree.persons_batch([fid]))
+            resource = parts[5]
+            if resource == 'sources.json':
+                return self.reply_json(tree.person_sources(fid))
+            if resource == 'memories.json':
+                return self.reply_json(tree.person_memories(fid))
+            if resource == 'notes.json':
+                return self.reply_json(tree.person_notes(fid))
+            if resource == 'changes.json':
+                return self.reply_json(tree.changes(fid))
+            if resource == 'ordinances.json':
+                return self.reply_json(tree.ordinances(fid))
+        if path.startswith('/platform/tree/couple-relationships/'):
+            relfid = parts[4].split('.')[0]
+            if len(parts) == 5:
+                return self.reply_json(tree.couple(relfid))
+            resource = parts[5]
+            if resource == 'sources.json':
+                return self.reply_json(tree.couple_sources(relfid))
+            if resource == 'notes.json':
+                return self.reply_json(tree.couple_notes(relfid))
+            if resource == 'changes.json':
+                return self.reply_json(tree.changes(relfid))
+        self.reply_json(None)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tree, password='password', latency=0, errors=0, expire=0, slow=0, verbose=False):
+        super(Server, self).__init__(address, Handler)
+        self.tree = tree
+        self.password = password
+        self.latency = latency
+        self.errors = errors
+        self.expire = expire
+        self.slow = slow
+        self.verbose = verbose
+        self.random = random.Random(1)
+        self.lock = threading.Lock()
+        self.sessions = dict()
+        self.counters = dict()
+
+    def count(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def new_session(self):
+        with self.lock:
+            token = 'TOKEN%05d' % len(self.sessions)
+            self.sessions[token] = time.time()
+        return token
+
+    def check_session(self, token):
+        created = self.sessions.get(token)
+        return created is not None and (not self.expire or time.time() - created < self.expire)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local FamilySearch stand-in server', add_help=False, usage='fsserver.py [options]')
+    parser.add_argument('-n', metavar='<INT>', type=int, default=1000, help='Number of individuals in the synthetic tree [1000]')
+    parser.add_argument('-b', metavar='<INT>', type=int, default=3, help='Number of children per couple [3]')
+    parser.add_argument('-s', metavar='<INT>', type=int, default=0, help='Random seed [0]')
+    parser.add_argument('-P', metavar='<INT>', type=int, default=8080, help='Port to listen on [8080]')
+    parser.add_argument('-L', metavar='<FLOAT>', type=float, default=0, help='Mean latency of API requests in seconds [0]')
+    parser.add_argument('-e', metavar='<FLOAT>', type=float, default=0, help='Fraction of API requests failing with 429 or 503 [0]')
+    parser.add_argument('-S', metavar='<FLOAT>', type=float, default=0, help='Latency of persons.json requests per person in seconds [0]')
+    parser.add_argument('-g', metavar='<FLOAT>', type=float, default=0, help='Fraction of deleted persons, whose persons.json requests fail with 410 [0]')
+    parser.add_argument('-c', metavar='<FLOAT>', type=float, default=0, help='Fraction of persons and couples modified when the server starts, downloaded again by --refresh [0]')
+    parser.add_argument('-x', metavar='<INT>', type=int, default=0, help='Expire sessions after this many seconds [never]')
+    parser.add_argument('-v', action='store_true', default=False, help='Log requests [False]')
+    try:
+        parser.error = parser.exit
+        args = parser.parse_args()
+    except SystemExit:
+        parser.print_help()
+        exit(2)
+
+    server = Server(('127.0.0.1', args.P), SyntheticTree(args.n, args.b, args.s, args.g, args.c), latency=args.L, errors=args.e, expire=args.x, slow=args.S, verbose=args.v)
+    sys.stderr.write('Serving %s individuals on http://127.0.0.1:%s (root %s)\n' % (len(server.tree.persons), server.server_address[1], server.tree.root))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.stderr.write('%s\n' % json.dumps(server.counters))
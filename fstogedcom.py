@@ -14,8 +14,8 @@ import os
 import sys
 
 # local import
-from getmyancestors import Session, Tree, Indi, Fam
-from mergemyancestors import Gedcom
+from getmyancestors import Session, Tree, Indi, Fam, RateLimiter, TokenCache, MAX_RATE
+from mergemyancestors import read_files
 from translation import translations
 
 
@@ -131,19 +131,14 @@ class Merge(Frame):
         filename = filedialog.asksaveasfilename(title=_('Save as'), defaultextension='.ged', filetypes=(('GEDCOM', '.ged'), (_('All files'), '*.*')))
         tree = Tree()
 
-        indi_counter = 0
-        fam_counter = 0
-
         # read the GEDCOM data
-        for file in self.files_to_merge.files.values():
-            ged = Gedcom(file, tree)
+        for ged in read_files(list(self.files_to_merge.files.values()), tree):
 
             # add informations about individuals
             for num in ged.indi:
                 fid = ged.indi[num].fid
                 if fid not in tree.indi:
-                    indi_counter += 1
-                    tree.indi[fid] = Indi(tree=tree, num=indi_counter)
+                    tree.indi[fid] = Indi(tree=tree)
                     tree.indi[fid].tree = tree
                     tree.indi[fid].fid = ged.indi[num].fid
                 tree.indi[fid].fams_fid |= ged.indi[num].fams_fid
@@ -168,8 +163,7 @@ class Merge(Frame):
             for num in ged.fam:
                 husb, wife = (ged.fam[num].husb_fid, ged.fam[num].wife_fid)
                 if (husb, wife) not in tree.fam:
-                    fam_counter += 1
-                    tree.fam[(husb, wife)] = Fam(husb, wife, tree, fam_counter)
+                    tree.fam[(husb, wife)] = Fam(husb, wife, tree)
                     tree.fam[(husb, wife)].tree = tree
                 tree.fam[(husb, wife)].chil_fid |= ged.fam[num].chil_fid
                 tree.fam[(husb, wife)].fid = ged.fam[num].fid
@@ -178,18 +172,7 @@ class Merge(Frame):
                 tree.fam[(husb, wife)].sources = ged.fam[num].sources
                 tree.fam[(husb, wife)].sealing_spouse = ged.fam[num].sealing_spouse
 
-        # merge notes by text
-        tree.notes = sorted(tree.notes, key=lambda x: x.text)
-        for i, n in enumerate(tree.notes):
-            if i == 0:
-                n.num = 1
-                continue
-            if n.text == tree.notes[i - 1].text:
-                n.num = tree.notes[i - 1].num
-            else:
-                n.num = tree.notes[i - 1].num + 1
-
-        # compute number for family relationships and print GEDCOM file
+        # number the records and print GEDCOM file
         tree.reset_num()
         with open(filename, 'w', encoding='utf-8') as file:
             tree.print(file)
@@ -377,7 +360,8 @@ class Download(Frame):
         self.btn_valid.config(state='disabled')
         self.info(_('Login to FamilySearch...'))
         self.logfile = open('download.log', 'w', encoding='utf-8')
-        self.fs = Session(self.sign_in.username.get(), self.sign_in.password.get(), verbose=True, logfile=self.logfile, timeout=1)
+        self.fs = Session(self.sign_in.username.get(), self.sign_in.password.get(), verbose=True, logfile=self.logfile, timeout=1, limiter=RateLimiter(MAX_RATE),
+                          tokens=TokenCache(os.path.join(tmp_dir, 'tokens.json')))
         if not self.fs.logged:
             messagebox.showinfo(_('Error'), message=_('The username or password was incorrect'))
             self.btn_valid.config(state='normal')
@@ -388,6 +372,11 @@ class Download(Frame):
         self.title.config(text=_('Options'))
         cache.delete('lang')
         cache.add('lang', self.fs.lang)
+        if not self.fs.get_userid():
+            messagebox.showinfo(_('Error'), message=_('Could not retrieve the current FamilySearch user'))
+            self.btn_valid.config(state='normal')
+            self.info('')
+            return
         lds_account = self.fs.get_url('/platform/tree/persons/%s/ordinances.json' % self.fs.get_userid()) != 'error'
         self.options = Options(self.form, lds_account)
         self.info('')
@@ -400,6 +389,8 @@ class Download(Frame):
 
     def quit(self):
         self.update_needed = False
+        if self.fs:
+            self.fs.log.close()
         if self.logfile:
             self.logfile.close()
         super(Download, self).quit()
@@ -419,50 +410,33 @@ class Download(Frame):
         self.btn_valid.config(state='disabled')
         self.info(_('Download starting individuals...'))
         self.info_tree = True
-        self.tree.add_indis(todo)
-        todo = set(todo)
-        done = set()
-        for i in range(self.options.ancestors.get()):
-            if not todo:
-                break
-            done |= todo
-            self.info(_('Download ') + str(i + 1) + _('th generation of ancestors...'))
-            todo = self.tree.add_parents(todo) - done
-
-        todo = set(self.tree.indi.keys())
-        done = set()
-        for i in range(self.options.descendants.get()):
-            if not todo:
-                break
-            done |= todo
-            self.info(_('Download ') + str(i + 1) + _('th generation of descendants...'))
-            todo = self.tree.add_children(todo) - done
+        self.tree.run(self.tree.add_indis(todo))
+        self.tree.run(self.tree.crawl(todo, self.options.ancestors.get(), self.options.descendants.get(), self.info))
 
         if self.options.spouses.get():
             self.info(_('Download spouses and marriage information...'))
             todo = set(self.tree.indi.keys())
-            self.tree.add_spouses(todo)
+            self.tree.run(self.tree.add_spouses(todo))
         ordi = self.options.ordinances.get()
         cont = self.options.contributors.get()
 
-        async def download_stuff(loop):
+        async def download_stuff():
             futures = set()
             for fid, indi in self.tree.indi.items():
-                futures.add(loop.run_in_executor(None, indi.get_notes))
+                futures.add(indi.get_notes())
                 if ordi:
-                    futures.add(loop.run_in_executor(None, self.tree.add_ordinances, fid))
+                    futures.add(self.tree.add_ordinances(fid))
                 if cont:
-                    futures.add(loop.run_in_executor(None, indi.get_contributors))
+                    futures.add(indi.get_contributors())
             for fam in self.tree.fam.values():
-                futures.add(loop.run_in_executor(None, fam.get_notes))
+                futures.add(fam.get_notes())
                 if cont:
-                    futures.add(loop.run_in_executor(None, fam.get_contributors))
-            for future in futures:
-                await future
+                    futures.add(fam.get_contributors())
+            await asyncio.gather(*futures)
 
-        loop = asyncio.get_event_loop()
         self.info(_('Download notes') + (((',' if cont else _(' and')) + _(' ordinances')) if ordi else '') + (_(' and contributors') if cont else '') + '...')
-        loop.run_until_complete(download_stuff(loop))
+        self.tree.run(download_stuff())
+        self.fs.close()
 
         self.tree.reset_num()
         self.btn_valid.config(command=self.save, state='normal', text=_('Save'))
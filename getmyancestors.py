@@ -24,11 +24,23 @@
 # global import
 from __future__ import print_function
 import sys
+import os
 import argparse
+import atexit
 import getpass
 import time
 import asyncio
 import re
+import json
+import random
+import threading
+import queue
+import zlib
+import email.utils
+import zipfile
+from bisect import bisect_right
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor
 
 # local import
 from translation import translations
@@ -40,7 +52,43 @@ except ImportError:
     sys.stderr.write('(run this in your terminal: "python3 -m pip install requests" or "python3 -m pip install --user requests")\n')
     exit(2)
 
+# optional non-blocking HTTP transport, the crawl falls back to requests in threads without it
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 MAX_PERSONS = 200  # is subject to change: see https://www.familysearch.org/developers/docs/api/tree/Persons_resource
+BATCH_LATENCY = 10  # seconds a persons.json request should take at most, the next batches are smaller above
+BATCH_STEP = 10  # persons added to the batches after each full batch downloaded in time
+MAX_BATCHES = 4  # default number of persons.json chunks of the same individuals downloaded at once
+MAX_WORKERS = 10  # number of concurrent HTTP requests, and of kept-alive connections per host
+MAX_RATE = 20  # default maximum number of requests per second
+MAX_ATTEMPTS = 10  # default maximum number of attempts of a request
+RETRY_BUDGET = 20  # default retries allowed, in percent of the requests
+RETRY_MIN = 10  # retries always allowed, whatever the number of requests
+RETRY_BASE = 1  # seconds to wait at most before the first retry, doubled at each attempt
+RETRY_CAP = 60  # seconds to wait at most before any retry
+TOKEN_TTL = 86400  # seconds during which a saved session id is tried before logging in
+CHECKPOINT_INTERVAL = 10  # seconds between two writes of the checkpoint file
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # upper bounds in seconds of the latency histograms
+LOG_LEVELS = ('debug', 'info', 'warning')  # levels of the log records, in increasing order
+LOG_QUEUE = 10000  # log records waiting for the writer thread, the next ones are dropped
+LOG_BATCH = 500  # maximum number of log records written at once
+POOL_HOSTS = 4  # hosts to keep connections to: familysearch.org, www.familysearch.org and ident.familysearch.org
+
+# seconds during which a cached response is used without revalidation, by endpoint (0: not cached)
+CACHE_TTL = {
+    'persons': 86400,
+    'person': 86400,
+    'sources': 7 * 86400,
+    'memories': 7 * 86400,
+    'notes': 7 * 86400,
+    'changes': 86400,
+    'ordinances': 7 * 86400,
+    'relationships': 86400,
+    'users': 0,
+}
 
 FACT_TAGS = {
     'http://gedcomx.org/Birth': 'BIRT',
@@ -83,140 +131,1097 @@ ORDINANCES_STATUS = {
 }
 
 
+# wrap a GEDCOM line in CONT and CONC lines of at most 255 bytes, which never start or end next to a space
 def cont(string):
     level = int(string[:1]) + 1
-    lines = string.splitlines()
     res = list()
     max_len = 255
-    for line in lines:
-        c_line = line
+    for line in string.splitlines():
+        # offsets[i] is the size of line[:i] in UTF-8, computed once for the line
+        if line.isascii():
+            offsets = range(len(line) + 1)
+        else:
+            offsets = [0]
+            offsets += accumulate(1 if c < '\x80' else 2 if c < '\u0800' else 3 if c < '\U00010000' else 4 for c in line)
         to_conc = list()
-        while len(c_line.encode('utf-8')) > max_len:
-            index = min(max_len, len(c_line) - 2)
-            while (len(c_line[:index].encode('utf-8')) > max_len or re.search(r'[ \t\v]', c_line[index - 1:index + 1])) and index > 1:
+        start = 0
+        while offsets[-1] - offsets[start] > max_len:
+            index = min(max_len, len(line) - start - 2)
+            if offsets[start + index] - offsets[start] > max_len:
+                index = max(bisect_right(offsets, offsets[start] + max_len, start, start + index) - 1 - start, 1)
+            while index > 1 and (line[start + index - 1] in ' \t\v' or line[start + index] in ' \t\v'):
                 index -= 1
-            to_conc.append(c_line[:index])
-            c_line = c_line[index:]
+            to_conc.append(line[start:start + index])
+            start += index
             max_len = 248
-        to_conc.append(c_line)
+        to_conc.append(line[start:])
         res.append(('\n%s CONC ' % level).join(to_conc))
         max_len = 248
     return ('\n%s CONT ' % level).join(res)
 
 
+# endpoint family of a FamilySearch API URL
+def endpoint(url):
+    parts = url.split('?')[0].split('/')
+    if parts[-1] == 'persons.json':
+        return 'persons'
+    if len(parts) > 5:
+        return parts[5].split('.')[0]
+    if len(parts) > 4 and parts[3] == 'couple-relationships':
+        return 'relationships'
+    if len(parts) > 4 and parts[3] == 'persons':
+        return 'person'
+    return parts[2] if len(parts) > 2 else url
+
+
+# split a persons.json response into one response per person, with its relationships and places
+def split_persons(data):
+    places = {place['id']: place for place in data.get('places', [])}
+    for person in data['persons']:
+        fid = person['id']
+        yield fid, {
+            'persons': [person],
+            'childAndParentsRelationships': [rel for rel in data.get('childAndParentsRelationships', [])
+                                             if fid in (rel.get(key, {}).get('resourceId') for key in ('father', 'mother', 'child'))],
+            'relationships': [rel for rel in data.get('relationships', [])
+                              if fid in (rel['person1']['resourceId'], rel['person2']['resourceId'])],
+            'places': [places[fact['place']['description'][1:]] for fact in person.get('facts', [])
+                       if 'description' in fact.get('place', {}) and fact['place']['description'][1:] in places],
+        }
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DECODER = json.JSONDecoder()
+
+
+# decode a JSON object member by member, and the elements of its arrays one by one, yielding (key, element) pairs,
+# so that a large response is never decoded as a whole
+def iter_json(text):
+    def skip(i):
+        return WHITESPACE.match(text, i).end()
+
+    def expect(i, char):
+        i = skip(i)
+        if text[i:i + 1] != char:
+            raise ValueError('Expecting %r at char %s' % (char, i))
+        return skip(i + 1)
+
+    i = expect(0, '{')
+    if text[i:i + 1] == '}':
+        return
+    while True:
+        key, i = DECODER.raw_decode(text, i)
+        i = expect(i, ':')
+        if text[i:i + 1] == '[':
+            i = skip(i + 1)
+            while text[i:i + 1] != ']':
+                value, i = DECODER.raw_decode(text, i)
+                yield key, value
+                i = skip(i)
+                if text[i:i + 1] != ']':
+                    i = expect(i, ',')
+            i += 1
+        else:
+            value, i = DECODER.raw_decode(text, i)
+            yield key, value
+        i = skip(i)
+        if text[i:i + 1] == '}':
+            return
+        i = expect(i, ',')
+
+
+# (key, element) pairs of a decoded persons.json response, like iter_json but with the places first
+def persons_items(data):
+    for key in ('places', 'persons', 'childAndParentsRelationships', 'relationships'):
+        for value in data.get(key, ()):
+            yield key, value
+
+
+# merge responses of split_persons into one persons.json response, None if there is no person
+def merge_persons(entries):
+    data = {'persons': [], 'childAndParentsRelationships': [], 'relationships': [], 'places': []}
+    for entry in entries:
+        for key, values in entry.items():
+            data[key] += values
+    return data if data['persons'] else None
+
+
+# on-disk cache of FamilySearch responses, shared by successive runs and concurrent processes
+class HttpCache:
+    def __init__(self, directory, size_limit=2 ** 30, ttl=None):
+        import diskcache
+        self.store = diskcache.Cache(directory, size_limit=size_limit)
+        self.ttl = dict(CACHE_TTL, **(ttl or {}))
+        self.hits = 0
+
+    # return the cached (time, body, etag, last modified) entry of an URL and whether it is still fresh
+    def get(self, account, url):
+        entry = self.store.get((account, url))
+        if entry is None:
+            return None, False
+        fresh = time.time() - entry[0] < self.ttl.get(endpoint(url), 0)
+        if fresh:
+            self.hits += 1
+        return entry, fresh
+
+    def set(self, account, url, body, headers, data=None):
+        if endpoint(url) == 'persons':
+            self.set_persons(account, data)
+        elif self.ttl.get(endpoint(url), 0):
+            self.store.set((account, url), (time.time(), body, headers.get('ETag'), headers.get('Last-Modified')))
+            if endpoint(url) == 'sources' and data:
+                self.set_sources(account, data['sourceDescriptions'])
+
+    # persons batches are cached person by person, with their relationships and places,
+    # so that batches of different runs or of overlapping roots can reuse them
+    def set_persons(self, account, data):
+        if not data or not self.ttl.get('persons', 0):
+            return
+        for fid, entry in split_persons(data):
+            self.store.set((account, 'person', fid), (time.time(), json.dumps(entry)))
+
+    # return the fresh cached persons of a list as one batch, and the persons still to download
+    def get_persons(self, account, fids):
+        entries = list()
+        missing = list()
+        for fid in fids:
+            entry = self.store.get((account, 'person', fid))
+            if entry is None or time.time() - entry[0] >= self.ttl.get('persons', 0):
+                missing.append(fid)
+                continue
+            self.hits += 1
+            entries.append(json.loads(entry[1]))
+        return merge_persons(entries), missing
+
+    # source descriptions are shared by many persons and couples, they are also cached one by one
+    def set_sources(self, account, descriptions):
+        for description in descriptions:
+            self.store.set((account, 'source', description['id']), (time.time(), json.dumps(description)))
+
+    # return the fresh cached descriptions of a list of sources
+    def get_sources(self, account, fids):
+        descriptions = list()
+        for fid in fids:
+            entry = self.store.get((account, 'source', fid))
+            if entry is not None and time.time() - entry[0] < self.ttl.get('sources', 0):
+                self.hits += 1
+                descriptions.append(json.loads(entry[1]))
+        return descriptions
+
+    # the server confirmed that the cached entry is still valid
+    def revalidate(self, account, url, entry):
+        self.store.set((account, url), (time.time(),) + tuple(entry[1:]))
+
+
+# FamilySearch session ids saved by account, so that the next runs skip the login while they are valid;
+# the file is only readable by its owner, and not trusted if others can read it
+class TokenCache:
+    def __init__(self, path, ttl=TOKEN_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def load(self):
+        try:
+            if os.name == 'posix' and os.stat(self.path).st_mode & 0o077:
+                return dict()
+            with open(self.path, encoding='utf-8') as f:
+                tokens = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        return tokens if isinstance(tokens, dict) else dict()
+
+    def get(self, account):
+        entry = self.load().get(account)
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['fssessionid']
+        return None
+
+    # save the session id of an account, None to forget it
+    def set(self, account, token):
+        tokens = {key: entry for key, entry in self.load().items() if time.time() - entry['time'] < self.ttl}
+        if token:
+            tokens[account] = {'fssessionid': token, 'time': time.time()}
+        else:
+            tokens.pop(account, None)
+        fd = os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        if os.name == 'posix':
+            os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(tokens, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+# append-only journal of the responses downloaded by a run, to resume it without downloading them again
+class Checkpoint:
+    def __init__(self, path, resume=False, interval=CHECKPOINT_INTERVAL):
+        self.responses = dict()
+        # persons batches depend on the timings of the crawl, so they are looked up person by person
+        self.persons = dict()
+        self.phases = list()
+        self.interval = interval
+        self.buffer = list()
+        self.written = time.monotonic()
+        # reentrant, the journal is also written when the program exits in the middle of a record
+        self.lock = threading.RLock()
+        size = 0
+        if resume and os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    # a line cut by an interruption ends the journal
+                    try:
+                        entry = json.loads(line.decode('utf-8')) if line.endswith(b'\n') else None
+                    except ValueError:
+                        entry = None
+                    if not isinstance(entry, dict):
+                        break
+                    if 'phase' in entry:
+                        self.phases.append(entry['phase'])
+                    else:
+                        self.add(entry['url'], entry['data'])
+                    size += len(line)
+        self.file = open(path, 'ab' if resume else 'wb')
+        self.file.truncate(size)
+
+    def __contains__(self, url):
+        return url in self.responses
+
+    def get(self, url):
+        return self.responses[url]
+
+    def add(self, url, data):
+        if endpoint(url) == 'persons':
+            if data:
+                self.persons.update(split_persons(data))
+        else:
+            self.responses[url] = data
+
+    # return the recorded persons of a list as one batch, and the persons still to download
+    def get_persons(self, fids):
+        return merge_persons(self.persons[fid] for fid in fids if fid in self.persons), [fid for fid in fids if fid not in self.persons]
+
+    # record a response, the journal is written at most every interval seconds
+    def record(self, url, data):
+        with self.lock:
+            self.add(url, data)
+            self.buffer.append(json.dumps({'url': url, 'data': data}, separators=(',', ':')) + '\n')
+            if time.monotonic() - self.written > self.interval:
+                self.flush()
+
+    # record the end of a phase of the run
+    def phase(self, name):
+        with self.lock:
+            self.phases.append(name)
+            self.buffer.append(json.dumps({'phase': name}) + '\n')
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer).encode('utf-8'))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buffer = list()
+        self.written = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.flush()
+                self.file.close()
+
+
+# archive of the responses served to a run, recorded to replay the run offline with other options;
+# a zip file whose central directory indexes the responses by URL, persons and source descriptions one by one
+class Cassette:
+    def __init__(self, path, replay=False):
+        self.replay = replay
+        self.archive = zipfile.ZipFile(path, 'r' if replay else 'w', zipfile.ZIP_DEFLATED)
+        self.names = set(self.archive.namelist())
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, url):
+        return url in self.names
+
+    def get(self, name):
+        with self.lock:
+            body = self.archive.read(name)
+        return json.loads(body)
+
+    def put(self, name, data):
+        body = json.dumps(data, separators=(',', ':'))
+        with self.lock:
+            if name not in self.names and self.archive.fp:
+                self.names.add(name)
+                self.archive.writestr(name, body)
+
+    # record a JSON structure served to the run, persons batches depend on the options so they are split by person
+    def record(self, url, data):
+        if self.replay:
+            return
+        if endpoint(url) == 'persons':
+            if data:
+                for fid, entry in split_persons(data):
+                    self.put('person/' + fid, entry)
+        else:
+            self.put(url, data)
+            if endpoint(url) == 'sources' and data:
+                self.record_sources(data['sourceDescriptions'])
+
+    def record_sources(self, descriptions):
+        if not self.replay:
+            for description in descriptions:
+                self.put('source/' + description['id'], description)
+
+    # return the recorded persons of a list as one batch, and the persons not recorded
+    def get_persons(self, fids):
+        return merge_persons(self.get('person/' + fid) for fid in fids if 'person/' + fid in self.names), [fid for fid in fids if 'person/' + fid not in self.names]
+
+    def get_sources(self, fids):
+        return [self.get('source/' + fid) for fid in fids if 'source/' + fid in self.names]
+
+    def close(self):
+        with self.lock:
+            self.archive.close()
+
+
+# seconds to wait according to a Retry-After header, which is either a delay or a date
+def retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+# whether the server asks to wait before the next requests (HTTP 429, or 503 with Retry-After): the request is sent
+# again after the pause, it is not a failure
+def throttled(status, headers):
+    return status == 429 or status == 503 and 'Retry-After' in headers
+
+
+# token bucket shared by all the requests of a session
+class RateLimiter:
+    def __init__(self, rate=None, burst=None):
+        self.max_rate = self.rate = rate
+        self.burst = burst if burst else max(1, int(rate or 1))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # take a token if there is one, otherwise return how long to wait for it
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.paused_until - now
+            if delay > 0:
+                return delay
+            if not self.rate:
+                return 0
+            self.tokens = min(self.burst, self.tokens + max(0, now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                # additive increase back to the configured rate
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 1000)
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    # wait until a request can be sent
+    def acquire(self):
+        delay = self.take()
+        while delay:
+            time.sleep(delay)
+            delay = self.take()
+
+    # wait until a request can be sent, without blocking the event loop
+    async def wait(self):
+        delay = self.take()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self.take()
+
+    # stop every request for some time and slow down, the server is overloaded (HTTP 429)
+    def pause(self, delay):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.last = self.paused_until
+            self.tokens = 0
+            if self.rate:
+                self.rate = max(self.max_rate / 10, self.rate * 0.9)
+
+
+# number of persons per persons.json request: additive increase while full batches are downloaded in time,
+# halved when a batch is slow or fails
+class BatchSize:
+    def __init__(self, size=MAX_PERSONS, latency=BATCH_LATENCY):
+        self.max_size = self.size = size
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def done(self, count, seconds, failed=False):
+        with self.lock:
+            if failed or seconds > self.latency:
+                self.size = max(1, self.size // 2)
+            elif count >= self.size:
+                self.size = min(self.max_size, self.size + BATCH_STEP)
+
+
+# request failed without retry: timeout, connection error or server error
+class Unavailable(Exception):
+    pass
+
+
+# exponential backoff with full jitter, bounded for each request and by a retry budget shared by all the requests
+class RetryPolicy:
+    def __init__(self, attempts=MAX_ATTEMPTS, budget=RETRY_BUDGET, base=RETRY_BASE, cap=RETRY_CAP):
+        self.attempts = attempts
+        self.budget = budget
+        self.base = base
+        self.cap = cap
+        self.retries = dict()
+        self.lock = threading.Lock()
+
+    # seconds to wait before the next attempt of a request which failed `attempt` times, None to give up
+    def backoff(self, key, attempt, sent):
+        with self.lock:
+            if self.attempts and attempt >= self.attempts:
+                return None
+            retries = sum(self.retries.values())
+            if self.budget is not None and retries >= RETRY_MIN + self.budget * (sent - retries) / 100:
+                return None
+            self.retries[key] = self.retries.get(key, 0) + 1
+        return random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+    # number of retries by endpoint
+    def stats(self):
+        with self.lock:
+            return dict(self.retries)
+
+
+# requests of a session by endpoint: status codes, latency histograms, bytes received, errors, cached responses,
+# and the time spent waiting for the rate limiter or before retries
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.endpoints = dict()
+        self.sleep = {'rate': 0.0, 'backoff': 0.0}
+        self.relogins = 0
+        self.lock = threading.Lock()
+
+    def endpoint(self, key):
+        if key not in self.endpoints:
+            self.endpoints[key] = {'statuses': dict(), 'errors': dict(), 'cached': dict(), 'bytes': 0,
+                                   'latency': [0] * (len(LATENCY_BUCKETS) + 1), 'seconds': 0.0}
+        return self.endpoints[key]
+
+    def response(self, key, status, seconds, size):
+        with self.lock:
+            entry = self.endpoint(key)
+            entry['statuses'][str(status)] = entry['statuses'].get(str(status), 0) + 1
+            entry['bytes'] += size
+            entry['seconds'] += seconds
+            entry['latency'][sum(seconds > bound for bound in LATENCY_BUCKETS)] += 1
+
+    # a request without response: timeout or connection error
+    def error(self, key, kind):
+        with self.lock:
+            entry = self.endpoint(key)
+            entry['errors'][kind] = entry['errors'].get(kind, 0) + 1
+
+    # a response read from the cache, the checkpoint or the cassette instead of being downloaded
+    def hit(self, key, source):
+        with self.lock:
+            entry = self.endpoint(key)
+            entry['cached'][source] = entry['cached'].get(source, 0) + 1
+
+    def slept(self, reason, seconds):
+        with self.lock:
+            self.sleep[reason] += seconds
+
+    # a login after the server rejected the session id
+    def relogin(self):
+        with self.lock:
+            self.relogins += 1
+
+    # report of the run as a JSON structure, with the retries and connections counted by the session
+    def report(self, retries=None, sent=0, opened=0):
+        retries = retries or dict()
+        with self.lock:
+            endpoints = dict()
+            for key in sorted(set(self.endpoints) | set(retries)):
+                entry = self.endpoint(key)
+                buckets = dict()
+                count = 0
+                for bound, number in zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], entry['latency']):
+                    count += number
+                    buckets[bound] = count
+                endpoints[key] = {
+                    'requests': sum(entry['statuses'].values()) + sum(entry['errors'].values()),
+                    'statuses': dict(sorted(entry['statuses'].items())),
+                    'errors': dict(sorted(entry['errors'].items())),
+                    'retries': retries.get(key, 0),
+                    'cached': dict(sorted(entry['cached'].items())),
+                    'bytes': entry['bytes'],
+                    'latency': {'count': count, 'sum': round(entry['seconds'], 6), 'buckets': buckets},
+                }
+            return {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+                'seconds': round(time.time() - self.started, 3),
+                'requests': sent,
+                'connections': opened,
+                'relogins': self.relogins,
+                'sleep': {reason: round(seconds, 6) for reason, seconds in self.sleep.items()},
+                'endpoints': endpoints,
+            }
+
+
+# a report of Metrics in the Prometheus text format
+def prometheus(report):
+    lines = list()
+
+    def metric(name, kind, description, samples):
+        lines.append('# HELP getmyancestors_%s %s' % (name, description))
+        lines.append('# TYPE getmyancestors_%s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            labels = ','.join('%s="%s"' % label for label in labels)
+            lines.append('getmyancestors_%s%s%s %s' % (name, suffix, '{%s}' % labels if labels else '', value))
+
+    endpoints = sorted(report['endpoints'].items())
+    metric('requests_total', 'counter', 'HTTP requests sent, attempts and logins included', [('', (), report['requests'])])
+    metric('connections_total', 'counter', 'HTTP connections opened', [('', (), report['connections'])])
+    metric('relogins_total', 'counter', 'Logins after the session expired', [('', (), report['relogins'])])
+    metric('responses_total', 'counter', 'HTTP responses by endpoint and status code',
+           [('', (('endpoint', key), ('status', status)), number) for key, entry in endpoints for status, number in entry['statuses'].items()])
+    metric('request_errors_total', 'counter', 'HTTP requests without response by endpoint and error',
+           [('', (('endpoint', key), ('error', kind)), number) for key, entry in endpoints for kind, number in entry['errors'].items()])
+    metric('retries_total', 'counter', 'Retried requests by endpoint', [('', (('endpoint', key),), entry['retries']) for key, entry in endpoints])
+    metric('cached_responses_total', 'counter', 'Responses read from the cache, the checkpoint or the cassette by endpoint',
+           [('', (('endpoint', key), ('source', source)), number) for key, entry in endpoints for source, number in entry['cached'].items()])
+    metric('response_bytes_total', 'counter', 'Bytes of HTTP responses by endpoint', [('', (('endpoint', key),), entry['bytes']) for key, entry in endpoints])
+    samples = list()
+    for key, entry in endpoints:
+        samples += [('_bucket', (('endpoint', key), ('le', bound)), number) for bound, number in entry['latency']['buckets'].items()]
+        samples += [('_sum', (('endpoint', key),), entry['latency']['sum']), ('_count', (('endpoint', key),), entry['latency']['count'])]
+    metric('request_duration_seconds', 'histogram', 'Duration of HTTP requests by endpoint', samples)
+    metric('sleep_seconds_total', 'counter', 'Time spent by the requests waiting for the rate limiter or before retries, summed over concurrent requests', [('', (('reason', reason),), seconds) for reason, seconds in sorted(report['sleep'].items())])
+    return '\n'.join(lines) + '\n'
+
+
+# log written by a background thread, as text or JSON lines, so that logging does not slow down the requests;
+# warnings are always written, the other records of a request are all written or all skipped according to its URL
+class Log:
+    def __init__(self, file=sys.stderr, level='debug', sample=1.0, structured=False, size=LOG_QUEUE):
+        self.file = file
+        self.level = LOG_LEVELS.index(level)
+        self.sample = sample
+        self.structured = structured
+        self.queue = queue.Queue(size)
+        # records dropped as the queue was full, approximate as it is counted without lock
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        # timestamp of the text records, formatted once per second
+        self.second = self.timestamp = None
+
+    def kept(self, level, url):
+        if LOG_LEVELS.index(level) < self.level:
+            return False
+        return level == 'warning' or url is None or self.sample >= 1 or zlib.crc32(url.encode('utf-8')) < self.sample * 2 ** 32
+
+    def write(self, text, level='info', **fields):
+        if not self.kept(level, fields.get('url')):
+            return
+        if not self.thread:
+            with self.lock:
+                if not self.thread:
+                    self.thread = threading.Thread(target=self.run, name='log', daemon=True)
+                    self.thread.start()
+                    atexit.register(self.close)
+        try:
+            self.queue.put_nowait((time.time(), threading.current_thread().name, level, text, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def format(self, created, thread, level, text, fields):
+        if not self.structured:
+            second = int(created)
+            if second != self.second:
+                self.second, self.timestamp = second, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))
+            return '[%s]: %s\n' % (self.timestamp, text)
+        record = {'time': round(created, 3), 'level': level, 'thread': thread, 'message': text}
+        if 'url' in fields:
+            record['endpoint'] = endpoint(fields['url'])
+        record.update(fields)
+        return json.dumps(record, ensure_ascii=False) + '\n'
+
+    # write the records in batches until close
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < LOG_BATCH:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [self.format(*record) for record in records if record]
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self.format(time.time(), 'log', 'warning', 'WARNING: %s log records dropped' % dropped, {}))
+            try:
+                self.file.write(''.join(lines))
+                self.file.flush()
+            except ValueError:
+                # the file was closed
+                pass
+            for _ in records:
+                self.queue.task_done()
+            if None in records:
+                return
+
+    # wait until the records written so far are in the file
+    def flush(self):
+        if self.thread:
+            self.queue.join()
+
+    def close(self):
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+# connection pool class of urllib3 counting the connections it opens for a session
+def counting_pool(cls, session):
+    class CountingPool(cls):
+        def _new_conn(self):
+            session.count(opened=1)
+            return super(CountingPool, self)._new_conn()
+    return CountingPool
+
+
 # FamilySearch session class
 class Session:
-    def __init__(self, username, password, verbose=False, logfile=sys.stderr, timeout=60):
+    def __init__(self, username, password, verbose=False, logfile=sys.stderr, timeout=60, workers=MAX_WORKERS, cache=None, limiter=None, retry=None, checkpoint=None, metrics=None, server=None, cassette=None, log=None, tokens=None):
         self.username = username
         self.password = password
         self.verbose = verbose
         self.logfile = logfile
+        self.log = log if log else Log(logfile)
         self.timeout = timeout
+        self.cache = cache
+        self.limiter = limiter if limiter else RateLimiter()
+        self.retry = retry if retry else RetryPolicy()
+        self.checkpoint = checkpoint
+        self.metrics = metrics if metrics else Metrics()
+        # address of a stand-in server, such as fsserver.py, replacing every FamilySearch host
+        self.server = server
+        self.cassette = cassette
+        self.tokens = tokens
+        # result of the login after the rejection of each session id, which the requests rejected with it share
+        self.relogged = dict()
+        self.login_lock = threading.Lock()
         self.fid = self.lang = None
         self.counter = 0
+        self.sent = self.opened = 0
+        self.stats_lock = threading.Lock()
+        self.workers = workers
+        # event loop of the crawl, with the semaphore bounding its concurrent requests and its HTTP client
+        self.loop = self.semaphore = self.client = None
+        # threads running blocking requests when aiohttp is not installed
+        self.executor = None
+        # kept-alive connections of the blocking requests
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=workers)
+        pools = adapter.poolmanager.pool_classes_by_scheme
+        adapter.poolmanager.pool_classes_by_scheme = {scheme: counting_pool(cls, self) for scheme, cls in pools.items()}
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
         self.logged = self.login()
 
-    # Write in logfile if verbose enabled
-    def write_log(self, text):
+    # Write in logfile if verbose enabled, with the fields of JSON records
+    def write_log(self, text, level='info', **fields):
         if self.verbose:
-            self.logfile.write('[%s]: %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), text))
-
-    # retrieve FamilySearch session ID (https://familysearch.org/developers/docs/guides/oauth2)
-    def login(self):
+            self.log.write(text, level, **fields)
+
+    # count HTTP requests sent and connections opened
+    def count(self, sent=0, opened=0):
+        with self.stats_lock:
+            self.sent += sent
+            self.opened += opened
+
+    # wait for the rate limiter before sending a request
+    def throttle(self):
+        start = time.monotonic()
+        self.limiter.acquire()
+        self.metrics.slept('rate', time.monotonic() - start)
+        self.count(sent=1)
+
+    # seconds to wait before retrying a request, None to give up; a server error slows down every request
+    def backoff(self, key, attempt, server=False):
+        delay = self.retry.backoff(key, attempt, self.connection_stats()[0])
+        if delay is None:
+            self.write_log('WARNING: giving up %s after %s attempts' % (key, attempt), 'warning')
+        else:
+            self.write_log('Retrying %s in %.1f seconds' % (key, delay))
+            self.metrics.slept('backoff', delay)
+            if server:
+                self.limiter.pause(delay)
+        return delay
+
+    # URL of a path of a FamilySearch host
+    def address(self, host, path):
+        return (self.server or host) + path
+
+    # key of the saved session ids
+    def account(self):
+        return '%s@%s' % (self.username, self.server or 'familysearch.org')
+
+    # reuse the session id saved by a previous run if it is still valid, the probe also retrieves the current user
+    def reuse_token(self):
+        token = self.tokens.get(self.account())
+        if not token:
+            return False
+        url = '/platform/users/current.json'
+        self.write_log('Trying the saved session id', 'debug', url=url)
+        try:
+            self.throttle()
+            r = self.http.get(self.address('https://familysearch.org', url), cookies={'fssessionid': token}, timeout=self.timeout)
+            self.metrics.response('login', r.status_code, r.elapsed.total_seconds(), len(r.content))
+            if r.status_code != 200:
+                self.write_log('The saved session id expired', url=url, status=r.status_code)
+                return False
+            data = r.json()
+            self.fid = data['users'][0]['personId']
+            self.lang = data['users'][0]['preferredLanguage']
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError):
+            self.write_log('The saved session id could not be checked', 'warning', url=url)
+            return False
+        self.fssessionid = token
+        self.served(url, data)
+        self.write_log('FamilySearch session id: ' + self.fssessionid)
+        return True
+
+    # retrieve FamilySearch session ID (https://familysearch.org/developers/docs/guides/oauth2),
+    # reusing the saved one unless the server rejected it
+    def login(self, reuse=True):
+        if self.cassette and self.cassette.replay:
+            return True
+        if self.tokens and reuse and self.reuse_token():
+            return True
+        attempt = 0
         while True:
+            if attempt:
+                delay = self.backoff('login', attempt)
+                if delay is None:
+                    return False
+                time.sleep(delay)
+            attempt += 1
             try:
-                url = 'https://www.familysearch.org/auth/familysearch/login'
-                self.write_log('Downloading: ' + url)
-                r = requests.get(url, params={'ldsauth': False}, allow_redirects=False)
+                url = self.address('https://www.familysearch.org', '/auth/familysearch/login')
+                self.write_log('Downloading: ' + url, 'debug')
+                self.throttle()
+                r = self.http.get(url, params={'ldsauth': False}, allow_redirects=False)
+                self.metrics.response('login', r.status_code, r.elapsed.total_seconds(), len(r.content))
                 url = r.headers['Location']
-                self.write_log('Downloading: ' + url)
-                r = requests.get(url, allow_redirects=False)
+                self.write_log('Downloading: ' + url, 'debug')
+                self.throttle()
+                r = self.http.get(url, allow_redirects=False)
+                self.metrics.response('login', r.status_code, r.elapsed.total_seconds(), len(r.content))
                 idx = r.text.index('name="params" value="')
                 span = r.text[idx + 21:].index('"')
                 params = r.text[idx + 21:idx + 21 + span]
 
-                url = 'https://ident.familysearch.org/cis-web/oauth2/v3/authorization'
-                self.write_log('Downloading: ' + url)
-                r = requests.post(url, data={'params': params, 'userName': self.username, 'password': self.password}, allow_redirects=False)
+                url = self.address('https://ident.familysearch.org', '/cis-web/oauth2/v3/authorization')
+                self.write_log('Downloading: ' + url, 'debug')
+                self.throttle()
+                r = self.http.post(url, data={'params': params, 'userName': self.username, 'password': self.password}, allow_redirects=False)
+                self.metrics.response('login', r.status_code, r.elapsed.total_seconds(), len(r.content))
 
                 if 'The username or password was incorrect' in r.text:
-                    self.write_log('The username or password was incorrect')
+                    self.write_log('The username or password was incorrect', 'warning')
                     return False
 
                 if 'Invalid Oauth2 Request' in r.text:
-                    self.write_log('Invalid Oauth2 Request')
-                    time.sleep(self.timeout)
+                    self.write_log('Invalid Oauth2 Request', 'warning')
                     continue
 
                 url = r.headers['Location']
-                self.write_log('Downloading: ' + url)
-                r = requests.get(url, allow_redirects=False)
+                self.write_log('Downloading: ' + url, 'debug')
+                self.throttle()
+                r = self.http.get(url, allow_redirects=False)
+                self.metrics.response('login', r.status_code, r.elapsed.total_seconds(), len(r.content))
                 self.fssessionid = r.cookies['fssessionid']
             except requests.exceptions.ReadTimeout:
-                self.write_log('Read timed out')
+                self.write_log('Read timed out', 'warning')
                 continue
             except requests.exceptions.ConnectionError:
-                self.write_log('Connection aborted')
-                time.sleep(self.timeout)
+                self.write_log('Connection aborted', 'warning')
                 continue
             except requests.exceptions.HTTPError:
-                self.write_log('HTTPError')
-                time.sleep(self.timeout)
+                self.write_log('HTTPError', 'warning')
                 continue
             except KeyError:
-                self.write_log('KeyError')
-                time.sleep(self.timeout)
+                self.write_log('KeyError', 'warning')
                 continue
             except ValueError:
-                self.write_log('ValueError')
-                time.sleep(self.timeout)
+                self.write_log('ValueError', 'warning')
                 continue
             self.write_log('FamilySearch session id: ' + self.fssessionid)
+            if self.tokens:
+                try:
+                    self.tokens.set(self.account(), self.fssessionid)
+                except OSError as e:
+                    self.write_log('WARNING: could not save the session id: %s' % e, 'warning')
             return True
 
-    # retrieve JSON structure from FamilySearch URL
-    def get_url(self, url):
+    # log in again after a 401 to a request sent with the session id token: the first request rejected logs in,
+    # the others wait for it and retry with the new session id
+    def relogin(self, token):
+        with self.login_lock:
+            if token not in self.relogged:
+                self.metrics.relogin()
+                self.relogged[token] = self.login(False)
+            return self.relogged[token]
+
+    # look an URL up in the cache: return the cached entry, whether it is fresh and the headers to revalidate it
+    def lookup(self, url):
+        cached, fresh = self.cache.get(self.account(), url) if self.cache else (None, False)
+        headers = dict()
+        if cached and cached[2]:
+            headers['If-None-Match'] = cached[2]
+        if cached and cached[3]:
+            headers['If-Modified-Since'] = cached[3]
+        return cached, fresh, headers
+
+    # interpret the response to a request: return whether it is final and its JSON structure
+    def read(self, url, status, headers, body, cached, stream=False):
+        if status == 304 and cached:
+            self.cache.revalidate(self.account(), url, cached)
+            return True, json.loads(cached[1])
+        if status == 204:
+            return True, None
+        if status in {404, 405, 410, 500}:
+            self.write_log('WARNING: ' + url, 'warning', url=url, status=status)
+            return True, None
+        if throttled(status, headers):
+            delay = retry_after(headers.get('Retry-After'))
+            delay = self.timeout if delay is None else delay
+            self.write_log('Too many requests, pausing all requests for %s seconds' % delay, 'warning', url=url, status=status)
+            self.limiter.pause(delay)
+            return False, None
+        if status >= 500:
+            self.write_log('Server error %s' % status, 'warning', url=url, status=status)
+            return False, None
+        if status >= 400:
+            self.write_log('HTTPError', 'warning', url=url, status=status)
+            if status == 403:
+                error = json.loads(body)['errors'][0]
+                if 'message' in error and error['message'] == u'Unable to get ordinances.':
+                    self.write_log('Unable to get ordinances. Try with an LDS account or without option -c.', 'warning', url=url)
+                    return True, 'error'
+                self.write_log('WARNING: code 403 from %s %s' % (url, error['message'] or ''), 'warning', url=url)
+                return True, None
+            return False, None
+        if stream and not (self.cache or self.checkpoint or self.cassette):
+            # decoded person by person by the tree, the stores keep whole responses
+            try:
+                return True, iter_json(body.decode('utf-8'))
+            except UnicodeDecodeError as e:
+                self.write_log('WARNING: corrupted file from %s, error: %s' % (url, e), 'warning', url=url)
+                return True, None
+        try:
+            data = json.loads(body)
+        except Exception as e:
+            self.write_log('WARNING: corrupted file from %s, error: %s' % (url, e), 'warning', url=url)
+            return True, None
+        if self.cache:
+            self.cache.set(self.account(), url, body, headers, data)
+        return True, data
+
+    # record a JSON structure served to the run in the cassette
+    def served(self, url, data):
+        if self.cassette:
+            self.cassette.record(url, data)
+        return data
+
+    # record a downloaded JSON structure in the checkpoint
+    def downloaded(self, url, data):
+        if self.checkpoint:
+            self.checkpoint.record(url, data)
+        return self.served(url, data)
+
+    # JSON structure of an URL in the replayed cassette, None if it was not recorded
+    def replayed(self, url):
+        if url not in self.cassette:
+            self.write_log('WARNING: not in the cassette: ' + url, 'warning', url=url)
+            self.cassette.misses += 1
+            return None
+        self.metrics.hit(endpoint(url), 'cassette')
+        return self.cassette.get(url)
+
+    # retrieve JSON structure from FamilySearch URL, or with stream the (key, element) pairs of iter_json if possible;
+    # without retry, a timeout, connection error or server error without Retry-After raises Unavailable
+    def get_url(self, url, stream=False, retry=True):
+        if self.cassette and self.cassette.replay:
+            return self.replayed(url)
+        if self.checkpoint and url in self.checkpoint:
+            self.metrics.hit(endpoint(url), 'checkpoint')
+            return self.served(url, self.checkpoint.get(url))
+        cached, fresh, headers = self.lookup(url)
+        if fresh:
+            self.write_log('Cached: ' + url, 'debug', url=url)
+            self.metrics.hit(endpoint(url), 'cache')
+            return self.served(url, json.loads(cached[1]))
         self.counter += 1
+        attempt, server, failed = 0, False, False
         while True:
+            if attempt:
+                if failed and not retry:
+                    raise Unavailable(url)
+                delay = self.backoff(endpoint(url), attempt, server)
+                if delay is None:
+                    return None
+                time.sleep(delay)
+            attempt, server, failed = attempt + 1, False, False
             try:
-                self.write_log('Downloading: ' + url)
+                self.write_log('Downloading: ' + url, 'debug', url=url)
                 # r = requests.get(url, cookies = { 's_vi': self.s_vi, 'fssessionid' : self.fssessionid }, timeout = self.timeout)
-                r = requests.get('https://familysearch.org' + url, cookies={'fssessionid': self.fssessionid}, timeout=self.timeout)
+                self.throttle()
+                start = time.monotonic()
+                token = self.fssessionid
+                r = self.http.get(self.address('https://familysearch.org', url), cookies={'fssessionid': token}, headers=headers, timeout=self.timeout)
             except requests.exceptions.ReadTimeout:
-                self.write_log('Read timed out')
+                self.write_log('Read timed out', 'warning', url=url)
+                self.metrics.error(endpoint(url), 'timeout')
+                failed = True
                 continue
             except requests.exceptions.ConnectionError:
-                self.write_log('Connection aborted')
-                time.sleep(self.timeout)
+                self.write_log('Connection aborted', 'warning', url=url)
+                self.metrics.error(endpoint(url), 'connection')
+                failed = True
                 continue
-            self.write_log('Status code: ' + str(r.status_code))
-            if r.status_code == 204:
-                return None
-            if r.status_code in {404, 405, 410, 500}:
-                self.write_log('WARNING: ' + url)
-                return None
+            seconds = time.monotonic() - start
+            self.metrics.response(endpoint(url), r.status_code, seconds, len(r.content))
+            self.write_log('Status code: ' + str(r.status_code), url=url, status=r.status_code, seconds=round(seconds, 3), attempt=attempt)
             if r.status_code == 401:
-                self.login()
+                if not self.relogin(token):
+                    return None
+                attempt = 0
                 continue
-            try:
-                r.raise_for_status()
-            except requests.exceptions.HTTPError:
-                self.write_log('HTTPError')
-                if r.status_code == 403:
-                    if 'message' in r.json()['errors'][0] and r.json()['errors'][0]['message'] == u'Unable to get ordinances.':
-                        self.write_log('Unable to get ordinances. Try with an LDS account or without option -c.')
-                        return 'error'
-                    else:
-
-                        self.write_log('WARNING: code 403 from %s %s' % (url, r.json()['errors'][0]['message'] or ''))
+            done, data = self.read(url, r.status_code, r.headers, r.content, cached, stream)
+            if done:
+                return self.downloaded(url, data)
+            server = failed = r.status_code >= 500 and not throttled(r.status_code, r.headers)
+
+    # run a coroutine of the crawl in the event loop of the session
+    def run(self, coroutine):
+        if not self.loop:
+            self.loop = asyncio.new_event_loop()
+
+            # created in the loop, before Python 3.10 a semaphore is bound to the current loop when it is created
+            async def semaphore():
+                return asyncio.Semaphore(self.workers)
+            self.semaphore = self.loop.run_until_complete(semaphore())
+        return self.loop.run_until_complete(coroutine)
+
+    # close the event loop of the crawl and its HTTP client
+    def close(self):
+        if self.loop:
+            if self.client:
+                self.loop.run_until_complete(self.client.close())
+            self.loop.close()
+            self.loop = self.semaphore = self.client = None
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.log.flush()
+
+    # non-blocking HTTP client of the event loop, with kept-alive connections
+    def get_client(self):
+        if not self.client:
+            async def on_connection(session, context, params):
+                self.count(opened=1)
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(on_connection)
+            self.client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.workers), trace_configs=[trace])
+        return self.client
+
+    # retrieve JSON structure from FamilySearch URL without blocking the event loop
+    async def aget_url(self, url, stream=False, retry=True):
+        if self.cassette and self.cassette.replay:
+            return self.replayed(url)
+        if self.checkpoint and url in self.checkpoint:
+            self.metrics.hit(endpoint(url), 'checkpoint')
+            return self.served(url, self.checkpoint.get(url))
+        loop = asyncio.get_event_loop()
+        if not aiohttp:
+            if not self.executor:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            async with self.semaphore:
+                return await loop.run_in_executor(self.executor, self.get_url, url, stream, retry)
+        cached, fresh, headers = self.lookup(url)
+        if fresh:
+            self.write_log('Cached: ' + url, 'debug', url=url)
+            self.metrics.hit(endpoint(url), 'cache')
+            return self.served(url, json.loads(cached[1]))
+        self.counter += 1
+        timeout = aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout)
+        attempt, server, failed = 0, False, False
+        async with self.semaphore:
+            while True:
+                if attempt:
+                    if failed and not retry:
+                        raise Unavailable(url)
+                    delay = self.backoff(endpoint(url), attempt, server)
+                    if delay is None:
                         return None
-                time.sleep(self.timeout)
-                continue
-            try:
-                return r.json()
-            except Exception as e:
-                self.write_log('WARNING: corrupted file from %s, error: %s' % (url, e))
-                return None
+                    await asyncio.sleep(delay)
+                attempt, server, failed = attempt + 1, False, False
+                try:
+                    self.write_log('Downloading: ' + url, 'debug', url=url)
+                    start = time.monotonic()
+                    await self.limiter.wait()
+                    self.metrics.slept('rate', time.monotonic() - start)
+                    self.count(sent=1)
+                    token = self.fssessionid
+                    cookie = {'Cookie': 'fssessionid=' + token}
+                    start = time.monotonic()
+                    async with self.get_client().get(self.address('https://familysearch.org', url), headers=dict(headers, **cookie), timeout=timeout) as r:
+                        status, response_headers, body = r.status, r.headers, await r.read()
+                except asyncio.TimeoutError:
+                    self.write_log('Read timed out', 'warning', url=url)
+                    self.metrics.error(endpoint(url), 'timeout')
+                    failed = True
+                    continue
+                except aiohttp.ClientError:
+                    self.write_log('Connection aborted', 'warning', url=url)
+                    self.metrics.error(endpoint(url), 'connection')
+                    failed = True
+                    continue
+                seconds = time.monotonic() - start
+                self.metrics.response(endpoint(url), status, seconds, len(body))
+                self.write_log('Status code: ' + str(status), url=url, status=status, seconds=round(seconds, 3), attempt=attempt)
+                if status == 401:
+                    if not await loop.run_in_executor(None, self.relogin, token):
+                        return None
+                    attempt = 0
+                    continue
+                done, data = self.read(url, status, response_headers, body, cached, stream)
+                if done:
+                    return self.downloaded(url, data)
+                server = failed = status >= 500 and not throttled(status, response_headers)
+
+    # number of HTTP requests sent and of connections opened to send them
+    def connection_stats(self):
+        with self.stats_lock:
+            return self.sent, self.opened
+
+    # JSON report of the requests of the session
+    def report(self):
+        return self.metrics.report(self.retry.stats(), *self.connection_stats())
 
     # retrieve FamilySearch current user ID
     def set_current(self):
@@ -239,21 +1244,35 @@ class Session:
         return string
 
 
+# GEDCOM record whose sets are created when first used, as most of them stay empty
+class Record:
+    __slots__ = ()
+    SETS = ()
+
+    def __getattr__(self, name):
+        if name not in self.SETS:
+            raise AttributeError(name)
+        value = set()
+        setattr(self, name, value)
+        return value
+
+    # elements of a set, without creating it
+    def get(self, name):
+        try:
+            return object.__getattribute__(self, name)
+        except AttributeError:
+            return ()
+
+
 # some GEDCOM objects
 class Note:
-
-    counter = 0
+    __slots__ = ('num', 'text')
 
     def __init__(self, text='', tree=None, num=None):
-        if num:
-            self.num = num
-        else:
-            Note.counter += 1
-            self.num = Note.counter
-        if tree:
-            tree.notes.append(self)
-
+        self.num = num
         self.text = text.strip()
+        if tree:
+            tree.notes.add(self)
 
     def print(self, file=sys.stdout):
         file.write(cont('0 @N' + str(self.num) + '@ NOTE ' + self.text) + '\n')
@@ -262,20 +1281,56 @@ class Note:
         file.write(str(level) + ' NOTE @N' + str(self.num) + '@\n')
 
 
-class Source:
-
-    counter = 0
+# notes of a tree indexed by text, the notes with the same text share a number and are printed once
+class Notes:
+    def __init__(self):
+        self.notes = list()
+        self.texts = dict()
+        self.lock = threading.Lock()
+
+    # add a note, the notes read from GEDCOM files are indexed when they are numbered as their text comes later
+    def add(self, note):
+        with self.lock:
+            self.notes.append(note)
+            if not note.num:
+                self.texts.setdefault(note.text, note)
+
+    # the note of a text, created and added the first time the text is seen
+    def intern(self, text):
+        text = text.strip()
+        with self.lock:
+            note = self.texts.get(text)
+            if not note:
+                note = self.texts[text] = Note(text)
+                self.notes.append(note)
+            return note
+
+    # number the notes in the order of their texts
+    def renumber(self):
+        with self.lock:
+            self.texts = dict()
+            for note in self.notes:
+                self.texts.setdefault(note.text, note)
+            nums = {text: num for num, text in enumerate(sorted(self.texts), 1)}
+            for note in self.notes:
+                note.num = nums[note.text]
+
+    # the notes printed, one per text
+    def __iter__(self):
+        return iter(list(self.texts.values()))
+
+    def __len__(self):
+        return len(self.texts)
+
+
+class Source(Record):
+    __slots__ = ('num', 'tree', 'url', 'citation', 'title', 'fid', 'notes')
+    SETS = ('notes',)
 
     def __init__(self, data=None, tree=None, num=None):
-        if num:
-            self.num = num
-        else:
-            Source.counter += 1
-            self.num = Source.counter
-
+        self.num = num
         self.tree = tree
         self.url = self.citation = self.title = self.fid = None
-        self.notes = set()
         if data:
             self.fid = data['id']
             if 'about' in data:
@@ -287,7 +1342,7 @@ class Source:
             if 'notes' in data:
                 for n in data['notes']:
                     if n['text']:
-                        self.notes.add(Note(n['text'], self.tree))
+                        self.notes.add(self.tree.notes.intern(n['text']))
 
     def print(self, file=sys.stdout):
         file.write('0 @S' + str(self.num) + '@ SOUR \n')
@@ -297,7 +1352,7 @@ class Source:
             file.write(cont('1 AUTH ' + self.citation) + '\n')
         if self.url:
             file.write(cont('1 PUBL ' + self.url) + '\n')
-        for n in self.notes:
+        for n in sorted(self.get('notes'), key=lambda x: x.num):
             n.link(file, 1)
         file.write('1 REFN ' + self.fid + '\n')
 
@@ -306,6 +1361,7 @@ class Source:
 
 
 class Fact:
+    __slots__ = ('value', 'type', 'date', 'place', 'note', 'map')
 
     def __init__(self, data=None, tree=None):
         self.value = self.type = self.date = self.place = self.note = self.map = None
@@ -325,13 +1381,16 @@ class Fact:
             if 'place' in data:
                 place = data['place']
                 self.place = place['original']
-                if 'description' in place and place['description'][1:] in tree.places:
-                    self.map = tree.places[place['description'][1:]]
+                self.map = tree.places.get(place, self)
             if 'changeMessage' in data['attribution']:
-                self.note = Note(data['attribution']['changeMessage'], tree)
+                self.note = tree.notes.intern(data['attribution']['changeMessage'])
             if self.type == 'http://gedcomx.org/Death' and not (self.date or self.place):
                 self.value = 'Y'
 
+    # order of the facts in the GEDCOM file
+    def key(self):
+        return (self.type or '', self.date or '', self.place or '', self.value or '')
+
     def print(self, file=sys.stdout, key=None):
         if self.type in FACT_TAGS:
             tmp = '1 ' + FACT_TAGS[self.type]
@@ -357,6 +1416,7 @@ class Fact:
 
 
 class Memorie:
+    __slots__ = ('description', 'url')
 
     def __init__(self, data=None):
         self.description = self.url = None
@@ -376,6 +1436,7 @@ class Memorie:
 
 
 class Name:
+    __slots__ = ('given', 'surname', 'prefix', 'suffix', 'note')
 
     def __init__(self, data=None, tree=None):
         self.given = ''
@@ -395,7 +1456,11 @@ class Name:
                     if z['type'] == u'http://gedcomx.org/Suffix':
                         self.suffix = z['value']
             if 'changeMessage' in data['attribution']:
-                self.note = Note(data['attribution']['changeMessage'], tree)
+                self.note = tree.notes.intern(data['attribution']['changeMessage'])
+
+    # order of the names in the GEDCOM file
+    def key(self):
+        return (self.given, self.surname, self.prefix or '', self.suffix or '')
 
     def print(self, file=sys.stdout, typ=None):
         tmp = '1 NAME ' + self.given + ' /' + self.surname + '/'
@@ -411,6 +1476,7 @@ class Name:
 
 
 class Ordinance:
+    __slots__ = ('date', 'temple_code', 'status', 'famc')
 
     def __init__(self, data=None):
         self.date = self.temple_code = self.status = self.famc = None
@@ -433,40 +1499,28 @@ class Ordinance:
 
 
 # GEDCOM individual class
-class Indi:
-
-    counter = 0
+class Indi(Record):
+    __slots__ = ('num', 'fid', 'tree', 'name', 'gender', 'baptism', 'confirmation', 'endowment', 'sealing_child',
+                 'famc_fid', 'fams_fid', 'famc_num', 'fams_num', 'parents', 'spouses', 'children',
+                 'nicknames', 'facts', 'birthnames', 'married', 'aka', 'notes', 'sources', 'memories')
+    SETS = __slots__[9:]
 
-    # initialize individual
+    # initialize individual, the number is given by Tree.reset_num unless it is read from a GEDCOM file
     def __init__(self, fid=None, tree=None, num=None):
-        if num:
-            self.num = num
-        else:
-            Indi.counter += 1
-            self.num = Indi.counter
+        self.num = num
         self.fid = fid
         self.tree = tree
-        self.famc_fid = set()
-        self.fams_fid = set()
-        self.famc_num = set()
-        self.fams_num = set()
         self.name = None
         self.gender = None
-        self.parents = set()
-        self.spouses = set()
-        self.children = set()
         self.baptism = self.confirmation = self.endowment = self.sealing_child = None
-        self.nicknames = set()
-        self.facts = set()
-        self.birthnames = set()
-        self.married = set()
-        self.aka = set()
-        self.notes = set()
-        self.sources = set()
-        self.memories = set()
 
+    # add a person of a persons.json response, return the coroutine downloading its sources and memories,
+    # which does not keep the response
     def add_data(self, data):
+        sources, evidence = None, False
         if data:
+            # the notes, sources and memories of a person unchanged since a previous export are reused
+            reused = self.tree.refresh and self.tree.refresh.reuse_indi(self, data)
             if data['names']:
                 for x in data['names']:
                     if x['preferred']:
@@ -490,29 +1544,27 @@ class Indi:
             if 'facts' in data:
                 for x in data['facts']:
                     if x['type'] == u'http://familysearch.org/v1/LifeSketch':
-                        self.notes.add(Note('=== ' + self.tree.fs._('Life Sketch') + ' ===\n' + x['value'], self.tree))
+                        if not reused:
+                            self.notes.add(self.tree.notes.intern('=== ' + self.tree.fs._('Life Sketch') + ' ===\n' + x['value']))
                     else:
                         self.facts.add(Fact(x, self.tree))
-            if 'sources' in data:
-                sources = self.tree.fs.get_url('/platform/tree/persons/%s/sources.json' % self.fid)
-                if sources:
-                    quotes = dict()
-                    for quote in sources['persons'][0]['sources']:
-                        quotes[quote['descriptionId']] = quote['attribution']['changeMessage'] if 'changeMessage' in quote['attribution'] else None
-                    for source in sources['sourceDescriptions']:
-                        if source['id'] not in self.tree.sources:
-                            self.tree.sources[source['id']] = Source(source, self.tree)
-                        self.sources.add((self.tree.sources[source['id']], quotes[source['id']]))
-            if 'evidence' in data:
-                url = '/platform/tree/persons/%s/memories.json' % self.fid
-                memorie = self.tree.fs.get_url(url)
-                if memorie and 'sourceDescriptions' in memorie:
-                    for x in memorie['sourceDescriptions']:
-                        if x['mediaType'] == 'text/plain':
-                            text = '\n'.join(val.get('value', '') for val in x.get('titles', []) + x.get('descriptions', []))
-                            self.notes.add(Note(text, self.tree))
-                        else:
-                            self.memories.add(Memorie(x))
+            if not reused:
+                sources, evidence = data.get('sources'), 'evidence' in data
+        return self.add_links(sources, evidence)
+
+    async def add_links(self, sources, evidence):
+        if sources:
+            self.sources |= await self.tree.get_sources(sources, '/platform/tree/persons/%s/sources.json' % self.fid)
+        if evidence:
+            url = '/platform/tree/persons/%s/memories.json' % self.fid
+            memorie = await self.tree.fs.aget_url(url)
+            if memorie and 'sourceDescriptions' in memorie:
+                for x in memorie['sourceDescriptions']:
+                    if x['mediaType'] == 'text/plain':
+                        text = '\n'.join(val.get('value', '') for val in x.get('titles', []) + x.get('descriptions', []))
+                        self.notes.add(self.tree.notes.intern(text))
+                    else:
+                        self.memories.add(Memorie(x))
 
     # add a fams to the individual
     def add_fams(self, fams):
@@ -523,22 +1575,25 @@ class Indi:
         self.famc_fid.add(famc)
 
     # retrieve individual notes
-    def get_notes(self):
-        notes = self.tree.fs.get_url('/platform/tree/persons/%s/notes.json' % self.fid)
+    async def get_notes(self):
+        if self.tree.refresh and self.fid in self.tree.refresh.reused:
+            return
+        notes = await self.tree.fs.aget_url('/platform/tree/persons/%s/notes.json' % self.fid)
         if notes:
             for n in notes['persons'][0]['notes']:
                 text_note = '=== ' + n['subject'] + ' ===\n' if 'subject' in n else ''
                 text_note += n['text'] + '\n' if 'text' in n else ''
-                self.notes.add(Note(text_note, self.tree))
+                self.notes.add(self.tree.notes.intern(text_note))
 
     # retrieve LDS ordinances
-    def get_ordinances(self):
+    async def get_ordinances(self):
         res = []
         famc = False
         url = '/platform/tree/persons/%s/ordinances.json' % self.fid
-        data = self.tree.fs.get_url(url)['persons'][0]['ordinances']
-        if data:
-            for o in data:
+        data = await self.tree.fs.aget_url(url)
+        # None when the request gave up, 'error' without LDS account
+        if data and data != 'error':
+            for o in data['persons'][0]['ordinances']:
                 if o['type'] == u'http://lds.org/Baptism':
                     self.baptism = Ordinance(o)
                 elif o['type'] == u'http://lds.org/Confirmation':
@@ -555,39 +1610,37 @@ class Indi:
         return res, famc
 
     # retrieve contributors
-    def get_contributors(self):
+    async def get_contributors(self):
+        if self.tree.refresh and self.fid in self.tree.refresh.reused:
+            return
         temp = set()
-        data = self.tree.fs.get_url('/platform/tree/persons/%s/changes.json' % self.fid)
+        data = await self.tree.fs.aget_url('/platform/tree/persons/%s/changes.json' % self.fid)
         if data:
             for entries in data['entries']:
                 for contributors in entries['contributors']:
                     temp.add(contributors['name'])
         if temp:
             text = '=== ' + self.tree.fs._('Contributors') + ' ===\n' + '\n'.join(sorted(temp))
-            for n in self.tree.notes:
-                if n.text == text:
-                    self.notes.add(n)
-                    return
-            self.notes.add(Note(text, self.tree))
+            self.notes.add(self.tree.notes.intern(text))
 
     # print individual information in GEDCOM format
     def print(self, file=sys.stdout):
         file.write('0 @I' + str(self.num) + '@ INDI\n')
         if self.name:
             self.name.print(file)
-        for o in self.nicknames:
+        for o in sorted(self.get('nicknames'), key=Name.key):
             file.write(cont('2 NICK ' + o.given + ' ' + o .surname) + '\n')
-        for o in self.birthnames:
+        for o in sorted(self.get('birthnames'), key=Name.key):
             o.print(file)
-        for o in self.aka:
+        for o in sorted(self.get('aka'), key=Name.key):
             o.print(file, 'aka')
-        for o in self.married:
+        for o in sorted(self.get('married'), key=Name.key):
             o.print(file, 'married')
         if self.gender:
             file.write('1 SEX ' + self.gender + '\n')
-        for o in self.facts:
+        for o in sorted(self.get('facts'), key=Fact.key):
             o.print(file)
-        for o in self.memories:
+        for o in sorted(self.get('memories'), key=lambda x: (x.url or '', x.description or '')):
             o.print(file)
         if self.baptism:
             file.write('1 BAPL\n')
@@ -601,40 +1654,33 @@ class Indi:
         if self.sealing_child:
             file.write('1 SLGC\n')
             self.sealing_child.print(file)
-        for num in self.fams_num:
+        for num in sorted(self.get('fams_num')):
             file.write('1 FAMS @F' + str(num) + '@\n')
-        for num in self.famc_num:
+        for num in sorted(self.get('famc_num')):
             file.write('1 FAMC @F' + str(num) + '@\n')
         file.write('1 _FSFTID ' + self.fid + '\n')
-        for o in self.notes:
+        for o in sorted(self.get('notes'), key=lambda x: x.num):
             o.link(file)
-        for source, quote in self.sources:
+        for source, quote in sorted(self.get('sources'), key=lambda x: (x[0].num, x[1] or '')):
             source.link(file, 1)
             if quote:
                 file.write(cont('2 PAGE ' + quote) + '\n')
 
 
 # GEDCOM family class
-class Fam:
-    counter = 0
+class Fam(Record):
+    __slots__ = ('num', 'husb_fid', 'wife_fid', 'tree', 'husb_num', 'wife_num', 'fid', 'sealing_spouse',
+                 'facts', 'chil_fid', 'chil_num', 'notes', 'sources')
+    SETS = __slots__[8:]
 
-    # initialize family
+    # initialize family, the number is given by Tree.reset_num unless it is read from a GEDCOM file
     def __init__(self, husb=None, wife=None, tree=None, num=None):
-        if num:
-            self.num = num
-        else:
-            Fam.counter += 1
-            self.num = Fam.counter
+        self.num = num
         self.husb_fid = husb if husb else None
         self.wife_fid = wife if wife else None
         self.tree = tree
         self.husb_num = self.wife_num = self.fid = None
-        self.facts = set()
         self.sealing_spouse = None
-        self.chil_fid = set()
-        self.chil_num = set()
-        self.notes = set()
-        self.sources = set()
 
     # add a child to the family
     def add_child(self, child):
@@ -642,54 +1688,42 @@ class Fam:
             self.chil_fid.add(child)
 
     # retrieve and add marriage information
-    def add_marriage(self, fid):
+    async def add_marriage(self, fid):
         if not self.fid:
             self.fid = fid
+            if self.tree.refresh and self.tree.refresh.reuse_fam(self, fid):
+                return
             url = '/platform/tree/couple-relationships/%s.json' % self.fid
-            data = self.tree.fs.get_url(url)
+            data = await self.tree.fs.aget_url(url)
             if data:
                 if 'facts' in data['relationships'][0]:
                     for x in data['relationships'][0]['facts']:
                         self.facts.add(Fact(x, self.tree))
                 if 'sources' in data['relationships'][0]:
-                    quotes = dict()
-                    for x in data['relationships'][0]['sources']:
-                        quotes[x['descriptionId']] = x['attribution']['changeMessage'] if 'changeMessage' in x['attribution'] else None
-                    new_sources = quotes.keys() - self.tree.sources.keys()
-                    if new_sources:
-                        sources = self.tree.fs.get_url('/platform/tree/couple-relationships/%s/sources.json' % self.fid)
-                        for source in sources['sourceDescriptions']:
-                            if source['id'] in new_sources and source['id'] not in self.tree.sources:
-                                self.tree.sources[source['id']] = Source(source, self.tree)
-                    for source_fid in quotes:
-                        self.sources.add((self.tree.sources[source_fid], quotes[source_fid]))
+                    self.sources |= await self.tree.get_sources(data['relationships'][0]['sources'], '/platform/tree/couple-relationships/%s/sources.json' % self.fid)
 
     # retrieve marriage notes
-    def get_notes(self):
-        if self.fid:
-            notes = self.tree.fs.get_url('/platform/tree/couple-relationships/%s/notes.json' % self.fid)
+    async def get_notes(self):
+        if self.fid and not (self.tree.refresh and self.fid in self.tree.refresh.reused):
+            notes = await self.tree.fs.aget_url('/platform/tree/couple-relationships/%s/notes.json' % self.fid)
             if notes:
                 for n in notes['relationships'][0]['notes']:
                     text_note = '=== ' + n['subject'] + ' ===\n' if 'subject' in n else ''
                     text_note += n['text'] + '\n' if 'text' in n else ''
-                    self.notes.add(Note(text_note, self.tree))
+                    self.notes.add(self.tree.notes.intern(text_note))
 
     # retrieve contributors
-    def get_contributors(self):
-        if self.fid:
+    async def get_contributors(self):
+        if self.fid and not (self.tree.refresh and self.fid in self.tree.refresh.reused):
             temp = set()
-            data = self.tree.fs.get_url('/platform/tree/couple-relationships/%s/changes.json' % self.fid)
+            data = await self.tree.fs.aget_url('/platform/tree/couple-relationships/%s/changes.json' % self.fid)
             if data:
                 for entries in data['entries']:
                     for contributors in entries['contributors']:
                         temp.add(contributors['name'])
             if temp:
                 text = '=== ' + self.tree.fs._('Contributors') + ' ===\n' + '\n'.join(sorted(temp))
-                for n in self.tree.notes:
-                    if n.text == text:
-                        self.notes.add(n)
-                        return
-                self.notes.add(Note(text, self.tree))
+                self.notes.add(self.tree.notes.intern(text))
 
     # print family information in GEDCOM format
     def print(self, file=sys.stdout):
@@ -698,77 +1732,419 @@ class Fam:
             file.write('1 HUSB @I' + str(self.husb_num) + '@\n')
         if self.wife_num:
             file.write('1 WIFE @I' + str(self.wife_num) + '@\n')
-        for num in self.chil_num:
+        for num in sorted(self.get('chil_num')):
             file.write('1 CHIL @I' + str(num) + '@\n')
-        for o in self.facts:
+        for o in sorted(self.get('facts'), key=Fact.key):
             o.print(file)
         if self.sealing_spouse:
             file.write('1 SLGS\n')
             self.sealing_spouse.print(file)
         if self.fid:
             file.write('1 _FSFTID ' + self.fid + '\n')
-        for o in self.notes:
+        for o in sorted(self.get('notes'), key=lambda x: x.num):
             o.link(file)
-        for source, quote in self.sources:
+        for source, quote in sorted(self.get('sources'), key=lambda x: (x[0].num, x[1] or '')):
             source.link(file, 1)
             if quote:
                 file.write(cont('2 PAGE ' + quote) + '\n')
 
 
+# persons requested by a crawl, in batches sent as soon as a request slot is free
+class Frontier:
+    def __init__(self, tree):
+        self.tree = tree
+        self.slots = tree.fs.workers
+        self.waiting = dict()
+        self.requested = set()
+        self.queue = list()
+        self.running = set()
+        self.scheduled = False
+
+    # wait until persons are in the tree, or failed to download
+    async def get(self, fids):
+        futures = list()
+        for fid in fids:
+            if not fid or fid in self.tree.indi:
+                continue
+            if fid not in self.requested:
+                self.requested.add(fid)
+                self.waiting[fid] = asyncio.get_event_loop().create_future()
+                self.queue.append(fid)
+            if fid in self.waiting:
+                futures.append(self.waiting[fid])
+        if self.queue and not self.scheduled:
+            # let the other coroutines woken up by the same batch add their persons first
+            self.scheduled = True
+            asyncio.get_event_loop().call_soon(self.dispatch)
+        await asyncio.gather(*futures)
+
+    # send the queued persons in as few batches as the free request slots allow
+    def dispatch(self):
+        self.scheduled = False
+        while self.queue and len(self.running) < self.slots:
+            size = self.tree.batch.size
+            batch, self.queue = self.queue[:size], self.queue[size:]
+            self.running.add(asyncio.ensure_future(self.fetch(batch)))
+
+    async def fetch(self, batch):
+        try:
+            await self.tree.add_indis(batch, self.found)
+        finally:
+            self.found(batch)
+            self.running.discard(asyncio.current_task())
+            self.dispatch()
+
+    def found(self, fids):
+        for fid in fids:
+            if fid in self.waiting:
+                self.waiting.pop(fid).set_result(None)
+
+    # wait until every batch is downloaded
+    async def join(self):
+        while self.running:
+            await asyncio.gather(*self.running)
+
+
+# coordinates of places by FamilySearch place description and by name, kept in a file shared by runs and trees
+class Places:
+    def __init__(self, path=None):
+        self.path = path
+        self.ids = dict()
+        self.names = dict()
+        self.changed = False
+        # facts of the persons.json response being added waiting for their place descriptions, which may come after them
+        self.waiting = None
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.ids = {fid: tuple(coordinates) for fid, coordinates in data['ids'].items()}
+            self.names = {name: tuple(coordinates) for name, coordinates in data['names'].items()}
+
+    # add a place description of a persons.json response
+    def add(self, place):
+        coordinates = (str(place['latitude']), str(place['longitude']))
+        with self.lock:
+            if self.ids.get(place['id']) != coordinates:
+                self.ids[place['id']] = coordinates
+                self.changed = True
+        if self.waiting:
+            for fact in self.waiting.pop(place['id'], ()):
+                fact.map = coordinates
+                self.add_name(fact.place, coordinates)
+
+    def add_name(self, name, coordinates):
+        with self.lock:
+            if name not in self.names:
+                self.names[name] = coordinates
+                self.changed = True
+
+    # add the coordinates of the places of a GEDCOM file, such as a previous export
+    def add_gedcom(self, file):
+        # imported here, mergemyancestors imports this module
+        from mergemyancestors import Gedcom
+        ged = Gedcom(file, Tree())
+        for record in list(ged.indi.values()) + list(ged.fam.values()):
+            for fact in record.get('facts'):
+                if fact.place and fact.map:
+                    self.add_name(fact.place, fact.map)
+
+    # return the coordinates of the place of a fact, by its description or else by its name
+    def get(self, place, fact=None):
+        fid = place.get('description', '')[1:]
+        coordinates = self.ids.get(fid)
+        if coordinates:
+            self.add_name(place['original'], coordinates)
+            return coordinates
+        if fid and fact and self.waiting is not None:
+            self.waiting.setdefault(fid, list()).append(fact)
+        return self.names.get(place['original'])
+
+    # write the places to the file, through a temporary file so that it is never left incomplete
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        with self.lock:
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'ids': self.ids, 'names': self.names}, f, ensure_ascii=False)
+            os.replace(self.path + '.tmp', self.path)
+            self.changed = False
+
+
+# previous GEDCOM export of the tree, whose records are reused for the persons and couples unchanged since
+class Refresh:
+    def __init__(self, file):
+        # imported here, mergemyancestors imports this module
+        from mergemyancestors import Gedcom
+        ged = Gedcom(file, Tree())
+        # start of the crawl which wrote the export, None for older exports whose records are all downloaded again:
+        # the time of the file is later than the downloads, and changed by a copy
+        self.since = ged.started
+        self.indi = {indi.fid: indi for indi in ged.indi.values() if indi.fid}
+        self.fam = {fam.fid: fam for fam in ged.fam.values() if fam.fid}
+        self.couples = {(fam.husb_fid, fam.wife_fid): fam for fam in ged.fam.values()}
+        self.unchanged = set()
+        self.reused = set()
+
+    def changed(self, data):
+        modified = data.get('attribution', {}).get('modified')
+        return modified is None or self.since is None or modified > self.since
+
+    # remember the couple relationships of a persons.json response unchanged since the export
+    def check(self, rel):
+        if rel['id'] in self.fam and not self.changed(rel):
+            self.unchanged.add(rel['id'])
+
+    def source(self, tree, source):
+        if source.fid not in tree.sources:
+            new = tree.sources[source.fid] = Source(tree=tree)
+            new.fid, new.title, new.citation, new.url = source.fid, source.title, source.citation, source.url
+            new.notes = {tree.notes.intern(n.text) for n in source.notes}
+        return tree.sources[source.fid]
+
+    # copy the notes, sources and memories of an unchanged person, return whether it is unchanged
+    def reuse_indi(self, indi, data):
+        if indi.fid not in self.indi or self.changed(data):
+            return False
+        old = self.indi[indi.fid]
+        indi.notes |= {indi.tree.notes.intern(n.text) for n in old.notes}
+        indi.sources |= {(self.source(indi.tree, source), quote) for source, quote in old.sources}
+        indi.memories |= old.memories
+        self.reused.add(indi.fid)
+        return True
+
+    # copy the marriage facts, notes and sources of an unchanged couple, return whether it is unchanged
+    def reuse_fam(self, fam, relfid):
+        if relfid not in self.unchanged:
+            return False
+        old = self.fam[relfid]
+        for fact in old.facts:
+            new = Fact()
+            new.value, new.type, new.date, new.place, new.map = fact.value, fact.type, fact.date, fact.place, fact.map
+            new.note = fam.tree.notes.intern(fact.note.text) if fact.note else None
+            fam.facts.add(new)
+        fam.notes |= {fam.tree.notes.intern(n.text) for n in old.notes}
+        fam.sources |= {(self.source(fam.tree, source), quote) for source, quote in old.sources}
+        self.reused.add(relfid)
+        return True
+
+    # copy the ordinances of an unchanged person, with the sealings to its parents and spouses
+    def reuse_ordinances(self, tree, indi):
+        old = self.indi[indi.fid]
+        indi.baptism, indi.confirmation, indi.endowment = old.baptism, old.confirmation, old.endowment
+        if old.sealing_child:
+            indi.sealing_child = Ordinance()
+            indi.sealing_child.date, indi.sealing_child.temple_code, indi.sealing_child.status = old.sealing_child.date, old.sealing_child.temple_code, old.sealing_child.status
+            if old.sealing_child.famc:
+                indi.sealing_child.famc = tree.fam.get((old.sealing_child.famc.husb_fid, old.sealing_child.famc.wife_fid))
+        for couple in old.fams_fid:
+            if couple in tree.fam and couple in self.couples and self.couples[couple].sealing_spouse:
+                tree.fam[couple].sealing_spouse = self.couples[couple].sealing_spouse
+
+
 # family tree class
 class Tree:
-    def __init__(self, fs=None):
+    def __init__(self, fs=None, batches=MAX_BATCHES, size=MAX_PERSONS):
         self.fs = fs
+        self.batches = batches
+        self.batch = BatchSize(size)
+        # persons which failed to download alone
+        self.failed = set()
         self.indi = dict()
         self.fam = dict()
-        self.notes = list()
+        self.notes = Notes()
         self.sources = dict()
-        self.places = dict()
-
-    # add individuals to the family tree
-    def add_indis(self, fids):
-        async def add_datas(loop, data):
-            futures = set()
-            for person in data['persons']:
-                self.indi[person['id']] = Indi(person['id'], self)
-                futures.add(loop.run_in_executor(None, self.indi[person['id']].add_data, person))
-            for future in futures:
-                await future
-
-        new_fids = [fid for fid in fids if fid and fid not in self.indi]
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        # loop = asyncio.get_event_loop()
-        while len(new_fids):
-            data = self.fs.get_url('/platform/tree/persons.json?pids=' + ','.join(new_fids[:MAX_PERSONS]))
+        self.places = Places()
+        self.refresh = None
+        # start of the crawl in milliseconds like the FamilySearch timestamps, written in the file for --refresh
+        self.started = int(time.time() * 1000) if fs else None
+
+    # run a coroutine in the event loop of the session, which is kept for the whole run
+    def run(self, coroutine):
+        return self.fs.run(coroutine)
+
+    # add individuals to the family tree, calling found with the persons whose relationships are known
+    async def add_indis(self, fids, found=None):
+        # sorted, so that the same persons are requested with the same URL
+        new_fids = sorted(fid for fid in fids if fid and fid not in self.indi)
+        stored = list()
+        if self.fs.cassette and self.fs.cassette.replay:
+            data, new_fids = self.fs.cassette.get_persons(new_fids)
+            stored.append(data)
+        if self.fs.checkpoint:
+            data, new_fids = self.fs.checkpoint.get_persons(new_fids)
+            stored.append(data)
+        if self.fs.cache:
+            data, new_fids = self.fs.cache.get_persons(self.fs.account(), new_fids)
+            stored.append(data)
+        for data in stored:
+            self.fs.served('/platform/tree/persons.json', data)
+        slots = asyncio.Semaphore(self.batches)
+
+        # return the responses of a chunk: a chunk failing is split in half instead of being retried,
+        # down to the persons which fail alone, such as merged or deleted persons
+        async def fetch(chunk):
+            async with slots:
+                start = time.monotonic()
+                try:
+                    data = await self.fs.aget_url('/platform/tree/persons.json?pids=' + ','.join(chunk), stream=True, retry=len(chunk) == 1)
+                except Unavailable:
+                    self.batch.done(len(chunk), time.monotonic() - start, True)
+                    data = None
+                else:
+                    if data is not None:
+                        self.batch.done(len(chunk), time.monotonic() - start)
+            if data is not None or len(chunk) == 1:
+                if data is None:
+                    self.fs.write_log('WARNING: could not download ' + chunk[0], 'warning')
+                    self.failed.add(chunk[0])
+                return [data]
+            self.fs.write_log('Splitting a batch of %s persons' % len(chunk))
+            first, second = await asyncio.gather(fetch(chunk[:len(chunk) // 2]), fetch(chunk[len(chunk) // 2:]))
+            return first + second
+
+        # chunks are downloaded concurrently but merged in order, so that the tree does not depend on timings,
+        # and released as soon as they are added
+        size = self.batch.size
+        batches = [[data] for data in stored] + [asyncio.ensure_future(fetch(new_fids[i:i + size])) for i in range(0, len(new_fids), size)]
+        stored = None
+        futures = list()
+        while batches:
+            responses = batches.pop(0)
+            if asyncio.isfuture(responses):
+                responses = await responses
+            for data in responses:
+                if data:
+                    futures += self.add_persons(data, found)
+            responses = None
+        await asyncio.gather(*futures)
+
+    # return the (source, quote) pairs of source references, whose descriptions are looked up in the tree,
+    # then in the cache, and are only downloaded from url, the sources.json of the record, if some are still unknown
+    async def get_sources(self, refs, url):
+        quotes = dict()
+        for ref in refs:
+            quotes[ref['descriptionId']] = ref.get('attribution', {}).get('changeMessage')
+        missing = [fid for fid in quotes if fid not in self.sources]
+        if missing and self.fs.cassette and self.fs.cassette.replay:
+            for description in self.fs.cassette.get_sources(missing):
+                self.add_source(description)
+            missing = [fid for fid in missing if fid not in self.sources]
+        if missing and self.fs.cache:
+            descriptions = self.fs.cache.get_sources(self.fs.account(), missing)
+            if self.fs.cassette:
+                self.fs.cassette.record_sources(descriptions)
+            for description in descriptions:
+                self.add_source(description)
+            missing = [fid for fid in missing if fid not in self.sources]
+        if missing:
+            data = await self.fs.aget_url(url)
             if data:
-                if 'places' in data:
-                    for place in data['places']:
-                        if place['id'] not in self.places:
-                            self.places[place['id']] = (str(place['latitude']), str(place['longitude']))
-                loop.run_until_complete(add_datas(loop, data))
-                if 'childAndParentsRelationships' in data:
-                    for rel in data['childAndParentsRelationships']:
-                        father = rel['father']['resourceId'] if 'father' in rel else None
-                        mother = rel['mother']['resourceId'] if 'mother' in rel else None
-                        child = rel['child']['resourceId'] if 'child' in rel else None
-                        if child in self.indi:
-                            self.indi[child].parents.add((father, mother))
-                        if father in self.indi:
-                            self.indi[father].children.add((father, mother, child))
-                        if mother in self.indi:
-                            self.indi[mother].children.add((father, mother, child))
-                if 'relationships' in data:
-                    for rel in data['relationships']:
-                        if rel['type'] == u'http://gedcomx.org/Couple':
-                            person1 = rel['person1']['resourceId']
-                            person2 = rel['person2']['resourceId']
-                            relfid = rel['id']
-                            if person1 in self.indi:
-                                self.indi[person1].spouses.add((person1, person2, relfid))
-                            if person2 in self.indi:
-                                self.indi[person2].spouses.add((person1, person2, relfid))
-            new_fids = new_fids[MAX_PERSONS:]
+                for description in data['sourceDescriptions']:
+                    self.add_source(description)
+        return {(self.sources[fid], quote) for fid, quote in quotes.items() if fid in self.sources}
+
+    def add_source(self, description):
+        if description['id'] not in self.sources:
+            self.sources[description['id']] = Source(description, self)
+
+    # add the persons of a persons.json response, decoded or as the pairs of iter_json, and their relationships;
+    # each person is built as it is decoded, the relationships once all the persons are known,
+    # then found is called with the persons, return the tasks downloading the sources and memories of the new ones
+    def add_persons(self, data, found=None):
+        fids = list()
+        links = list()
+        parents, couples = list(), list()
+        self.places.waiting = dict()
+        try:
+            for key, value in persons_items(data) if isinstance(data, dict) else data:
+                if key == 'places':
+                    self.places.add(value)
+                elif key == 'persons':
+                    fids.append(value['id'])
+                    if value['id'] not in self.indi:
+                        self.indi[value['id']] = Indi(value['id'], self)
+                        links.append(self.indi[value['id']].add_data(value))
+                elif key == 'childAndParentsRelationships':
+                    parents.append(value)
+                elif key == 'relationships':
+                    couples.append(value)
+        except ValueError as e:
+            self.fs.write_log('WARNING: corrupted persons.json response, error: %s' % e, 'warning')
+        finally:
+            self.places.waiting = None
+        for rel in parents:
+            father = rel['father']['resourceId'] if 'father' in rel else None
+            mother = rel['mother']['resourceId'] if 'mother' in rel else None
+            child = rel['child']['resourceId'] if 'child' in rel else None
+            if child in self.indi:
+                self.indi[child].parents.add((father, mother))
+            if father in self.indi:
+                self.indi[father].children.add((father, mother, child))
+            if mother in self.indi:
+                self.indi[mother].children.add((father, mother, child))
+        for rel in couples:
+            if rel['type'] == u'http://gedcomx.org/Couple':
+                person1 = rel['person1']['resourceId']
+                person2 = rel['person2']['resourceId']
+                relfid = rel['id']
+                if self.refresh:
+                    self.refresh.check(rel)
+                if person1 in self.indi:
+                    self.indi[person1].spouses.add((person1, person2, relfid))
+                if person2 in self.indi:
+                    self.indi[person2].spouses.add((person1, person2, relfid))
+        if found:
+            found(fids)
+        return [asyncio.ensure_future(link) for link in links]
+
+    # download the ancestors and the descendants of individuals, up to some generations
+    async def crawl(self, fids, ancestors=0, descendants=0, progress=None):
+        frontier = Frontier(self)
+        # generation at which each person was reached, it is expanded again if it is reached at a lower one
+        up, down = dict(), dict()
+        started = {'th generation of ancestors...': 0, 'th generation of descendants...': 0}
+
+        def start(kind, generation):
+            if generation > started[kind]:
+                started[kind] = generation
+                if progress:
+                    progress(self.fs._('Download ') + str(generation) + self.fs._(kind))
+
+        async def ascend(fid, generation):
+            if up.get(fid, ancestors + 1) <= generation:
+                return
+            up[fid] = generation
+            await frontier.get([fid])
+            if fid not in self.indi:
+                return
+            futures = [descend(fid, 0)]
+            if generation < ancestors:
+                start('th generation of ancestors...', generation + 1)
+                couples = set(self.indi[fid].parents)
+                await frontier.get(set.union(*(set(couple) for couple in couples)) if couples else set())
+                for father, mother in couples:
+                    if mother in self.indi and father in self.indi or not father and mother in self.indi or not mother and father in self.indi:
+                        self.add_trio(father, mother, fid)
+                    futures += [ascend(parent, generation + 1) for parent in (father, mother) if parent in self.indi]
+            await asyncio.gather(*futures)
+
+        async def descend(fid, generation):
+            if down.get(fid, descendants + 1) <= generation or generation >= descendants:
+                return
+            down[fid] = generation
+            start('th generation of descendants...', generation + 1)
+            rels = set(self.indi[fid].children)
+            await frontier.get(set.union(*(set(rel) for rel in rels)) if rels else set())
+            children = set()
+            for father, mother, child in rels:
+                if child in self.indi and (mother in self.indi and father in self.indi or not father and mother in self.indi or not mother and father in self.indi):
+                    self.add_trio(father, mother, child)
+                    children.add(child)
+            await asyncio.gather(*(descend(child, generation + 1) for child in children))
+
+        await asyncio.gather(*(ascend(fid, 0) for fid in fids))
+        await frontier.join()
 
     # add family to the family tree
     def add_fam(self, father, mother):
@@ -786,61 +2162,26 @@ class Tree:
             self.add_fam(father, mother)
             self.fam[(father, mother)].add_child(child)
 
-    # add parents relationships
-    def add_parents(self, fids):
-        parents = set()
-        for fid in (fids & self.indi.keys()):
-            for couple in self.indi[fid].parents:
-                parents |= set(couple)
-        if parents:
-            self.add_indis(parents)
-        for fid in (fids & self.indi.keys()):
-            for father, mother in self.indi[fid].parents:
-                if mother in self.indi and father in self.indi or not father and mother in self.indi or not mother and father in self.indi:
-                    self.add_trio(father, mother, fid)
-        return set(filter(None, parents))
-
     # add spouse relationships
-    def add_spouses(self, fids):
-        async def add(loop, rels):
-            futures = set()
-            for father, mother, relfid in rels:
-                if (father, mother) in self.fam:
-                    futures.add(loop.run_in_executor(None, self.fam[(father, mother)].add_marriage, relfid))
-            for future in futures:
-                await future
-
+    async def add_spouses(self, fids):
         rels = set()
         for fid in (fids & self.indi.keys()):
             rels |= self.indi[fid].spouses
-        loop = asyncio.get_event_loop()
         if rels:
-            self.add_indis(set.union(*({father, mother} for father, mother, relfid in rels)))
+            await self.add_indis(set.union(*({father, mother} for father, mother, relfid in rels)))
             for father, mother, relfid in rels:
                 if father in self.indi and mother in self.indi:
                     self.indi[father].add_fams((father, mother))
                     self.indi[mother].add_fams((father, mother))
                     self.add_fam(father, mother)
-            loop.run_until_complete(add(loop, rels))
-
-    # add children relationships
-    def add_children(self, fids):
-        rels = set()
-        for fid in (fids & self.indi.keys()):
-            rels |= self.indi[fid].children if fid in self.indi else set()
-        children = set()
-        if rels:
-            self.add_indis(set.union(*(set(rel) for rel in rels)))
-            for father, mother, child in rels:
-                if child in self.indi and (mother in self.indi and father in self.indi or not father and mother in self.indi or not mother and father in self.indi):
-                    self.add_trio(father, mother, child)
-                    children.add(child)
-        return children
+            await asyncio.gather(*(self.fam[(father, mother)].add_marriage(relfid) for father, mother, relfid in rels if (father, mother) in self.fam))
 
     # retrieve ordinances
-    def add_ordinances(self, fid):
-        if fid in self.indi:
-            ret, famc = self.indi[fid].get_ordinances()
+    async def add_ordinances(self, fid):
+        if self.refresh and fid in self.refresh.reused:
+            self.refresh.reuse_ordinances(self, self.indi[fid])
+        elif fid in self.indi:
+            ret, famc = await self.indi[fid].get_ordinances()
             if famc and famc in self.fam:
                 self.indi[fid].sealing_child.famc = self.fam[famc]
             for o in ret:
@@ -851,7 +2192,23 @@ class Tree:
                     self.fam[(o['spouse']['resourceId'], fid)
                              ].sealing_spouse = Ordinance(o)
 
+    # number the records in an order which only depends on their content, so that a tree is always written the same way
     def reset_num(self):
+        for num, fid in enumerate(sorted(self.indi, key=lambda x: x or ''), 1):
+            self.indi[fid].num = num
+        for num, (husb, wife) in enumerate(sorted(self.fam, key=lambda x: (x[0] or '', x[1] or '')), 1):
+            self.fam[(husb, wife)].num = num
+        for num, fid in enumerate(sorted(self.sources), 1):
+            self.sources[fid].num = num
+        self.notes.renumber()
+        # the sources and families of the records read from GEDCOM files are the ones of this tree
+        for record in list(self.indi.values()) + list(self.fam.values()):
+            if record.get('sources'):
+                record.sources = {(self.sources.get(source.fid, source), quote) for source, quote in record.sources}
+        for indi in self.indi.values():
+            famc = indi.sealing_child.famc if indi.sealing_child else None
+            if famc:
+                indi.sealing_child.famc = self.fam.get((famc.husb_fid, famc.wife_fid), famc)
         for husb, wife in self.fam:
             self.fam[(husb, wife)].husb_num = self.indi[husb].num if husb else None
             self.fam[(husb, wife)].wife_num = self.indi[wife].num if wife else None
@@ -867,6 +2224,8 @@ class Tree:
         file.write('1 GEDC\n')
         file.write('2 VERS 5.5\n')
         file.write('2 FORM LINEAGE-LINKED\n')
+        if self.started:
+            file.write('1 _STARTED %s\n' % self.started)
         for fid in sorted(self.indi, key=lambda x: self.indi.__getitem__(x).num):
             self.indi[fid].print(file)
         for husb, wife in sorted(self.fam, key=lambda x: self.fam.__getitem__(x).num):
@@ -874,11 +2233,7 @@ class Tree:
         sources = sorted(self.sources.values(), key=lambda x: x.num)
         for s in sources:
             s.print(file)
-        notes = sorted(self.notes, key=lambda x: x.num)
-        for i, n in enumerate(notes):
-            if i > 0:
-                if n.num == notes[i - 1].num:
-                    continue
+        for n in sorted(self.notes, key=lambda x: x.num):
             n.print(file)
         file.write('0 TRLR\n')
 
@@ -894,7 +2249,30 @@ if __name__ == '__main__':
     parser.add_argument('-r', action="store_true", default=False, help='Add list of contributors in notes [False]')
     parser.add_argument('-c', action="store_true", default=False, help='Add LDS ordinances (need LDS account) [False]')
     parser.add_argument("-v", action="store_true", default=False, help="Increase output verbosity [False]")
+    parser.add_argument('--log-level', metavar='<STR>', type=str, choices=LOG_LEVELS, default='debug', help='Lowest level of the records written with -v: debug, info or warning [debug]')
+    parser.add_argument('--log-sample', metavar='<FLOAT>', type=float, default=1.0, help='Fraction of the requests whose records are written with -v, warnings are always written [1]')
+    parser.add_argument('--log-json', action='store_true', default=False, help='Write the log as JSON lines with endpoint, status, duration and thread fields [False]')
     parser.add_argument('-t', metavar='<INT>', type=int, default=60, help='Timeout in seconds [60]')
+    parser.add_argument('--workers', metavar='<INT>', type=int, default=MAX_WORKERS, help='Number of concurrent HTTP requests [%s]' % MAX_WORKERS)
+    parser.add_argument('--batch-size', metavar='<INT>', type=int, default=MAX_PERSONS, help='Maximum number of persons per persons.json request, fewer while the requests are slow or fail [%s]' % MAX_PERSONS)
+    parser.add_argument('--batches', metavar='<INT>', type=int, default=MAX_BATCHES, help='Number of persons.json requests for the same individuals sent at once [%s]' % MAX_BATCHES)
+    parser.add_argument('--rate', metavar='<FLOAT>', type=float, default=MAX_RATE, help='Maximum number of requests per second, 0 for no limit [%s]' % MAX_RATE)
+    parser.add_argument('--burst', metavar='<INT>', type=int, help='Maximum number of requests sent at once when under the rate [rate]')
+    parser.add_argument('--retries', metavar='<INT>', type=int, default=MAX_ATTEMPTS, help='Maximum number of attempts of a request, 0 for no limit [%s]' % MAX_ATTEMPTS)
+    parser.add_argument('--retry-budget', metavar='<FLOAT>', type=float, default=RETRY_BUDGET, help='Maximum number of retries in percent of the requests [%s]' % RETRY_BUDGET)
+    parser.add_argument('--checkpoint', metavar='<FILE>', type=str, help='Record downloaded data in this file to resume an interrupted run [none]')
+    parser.add_argument('--resume', action='store_true', default=False, help='Resume the run recorded in the checkpoint file [False]')
+    parser.add_argument('--record', metavar='<FILE>', type=str, help='Record the responses of the run in this archive, to replay it with --replay [none]')
+    parser.add_argument('--replay', metavar='<FILE>', type=str, help='Serve the run from an archive written by --record, without connecting to FamilySearch [none]')
+    parser.add_argument('--refresh', metavar='<FILE>', type=argparse.FileType('r', encoding='UTF-8'), help='Previous GEDCOM output of the same options, whose persons unchanged since its download started are not downloaded again [none]')
+    parser.add_argument('--places', metavar='<FILE>', type=str, help='Keep the coordinates of places in this file, shared by runs and trees [none]')
+    parser.add_argument('--places-from', metavar='<FILE>', nargs='+', type=argparse.FileType('r', encoding='UTF-8'), help='Previous GEDCOM exports whose place coordinates are used for the places without them [none]')
+    parser.add_argument('--metrics-out', metavar='<FILE>', type=argparse.FileType('w', encoding='UTF-8'), help='Write a JSON report of the HTTP requests by endpoint to this file [none]')
+    parser.add_argument('--metrics-prometheus', metavar='<FILE>', type=argparse.FileType('w', encoding='UTF-8'), help='Write the same metrics in the Prometheus text format to this file [none]')
+    parser.add_argument('--server', metavar='<URL>', type=str, help='Send the requests to this server instead of FamilySearch, such as fsserver.py [FamilySearch]')
+    parser.add_argument('--token-cache', metavar='<FILE>', type=str, help='Save the FamilySearch session in this file, only readable by you, and reuse it while it is valid [none]')
+    parser.add_argument('--cache', metavar='<DIR>', type=str, help='Cache FamilySearch responses in this directory [no cache]')
+    parser.add_argument('--cache-size', metavar='<INT>', type=int, default=1024, help='Maximum size of the cache in MB [1024]')
     try:
         parser.add_argument('-o', metavar='<FILE>', type=argparse.FileType('w', encoding='UTF-8'), default=sys.stdout, help='output GEDCOM file [stdout]')
         parser.add_argument('-l', metavar='<FILE>', type=argparse.FileType('w', encoding='UTF-8'), default=sys.stderr, help='output log file [stderr]')
@@ -911,23 +2289,58 @@ if __name__ == '__main__':
         parser.print_help()
         exit(2)
 
+    if args.resume and not args.checkpoint:
+        exit('Option --resume requires a checkpoint file')
+
+    if args.replay and (args.record or args.checkpoint or args.cache):
+        exit('Option --replay cannot be used with --record, --checkpoint or --cache')
+
     if args.i:
         for fid in args.i:
             if not re.match(r'[A-Z0-9]{4}-[A-Z0-9]{3}', fid):
                 exit('Invalid FamilySearch ID: ' + fid)
 
-    username = args.u if args.u else input("Enter FamilySearch username: ")
-    password = args.p if args.p else getpass.getpass("Enter FamilySearch password: ")
+    # a replayed run does not log in
+    username = args.u if args.u or args.replay else input("Enter FamilySearch username: ")
+    password = args.p if args.p or args.replay else getpass.getpass("Enter FamilySearch password: ")
 
     time_count = time.time()
 
     # initialize a FamilySearch session and a family tree object
     print('Login to FamilySearch...')
-    fs = Session(username, password, args.v, args.l, args.t)
+    try:
+        cache = HttpCache(args.cache, args.cache_size * 2 ** 20) if args.cache else None
+    except ImportError:
+        sys.stderr.write('You need to install the diskcache module first\n')
+        sys.stderr.write('(run this in your terminal: "python3 -m pip install diskcache" or "python3 -m pip install --user diskcache")\n')
+        exit(2)
+    if not aiohttp:
+        sys.stderr.write('Install the aiohttp module for faster downloads\n')
+        sys.stderr.write('(run this in your terminal: "python3 -m pip install aiohttp" or "python3 -m pip install --user aiohttp")\n')
+    checkpoint = Checkpoint(args.checkpoint, args.resume) if args.checkpoint else None
+    if checkpoint:
+        atexit.register(checkpoint.close)
+        if checkpoint.phases:
+            print('Resume after: ' + ', '.join(checkpoint.phases))
+    cassette = Cassette(args.replay, True) if args.replay else Cassette(args.record) if args.record else None
+    if cassette:
+        atexit.register(cassette.close)
+    fs = Session(username, password, args.v, args.l, args.t, args.workers, cache, RateLimiter(args.rate, args.burst), RetryPolicy(args.retries, args.retry_budget), checkpoint, server=args.server, cassette=cassette, log=Log(args.l, args.log_level, args.log_sample, args.log_json),
+                 tokens=TokenCache(args.token_cache) if args.token_cache else None)
     if not fs.logged:
         exit(2)
     _ = fs._
-    tree = Tree(fs)
+    tree = Tree(fs, args.batches, args.batch_size)
+    if args.refresh:
+        tree.refresh = Refresh(args.refresh)
+        if tree.refresh.since is None:
+            print(_('%s does not record when its download started, it is downloaded again.') % args.refresh.name)
+    tree.places = Places(args.places)
+    for file in args.places_from or []:
+        tree.places.add_gedcom(file)
+
+    if (args.c or not args.i) and not fs.get_userid():
+        exit('Could not retrieve the current FamilySearch user, try again later or with option -i')
 
     # check LDS account
     if args.c and fs.get_url('/platform/tree/persons/%s/ordinances.json' % fs.get_userid()) == 'error':
@@ -936,55 +2349,66 @@ if __name__ == '__main__':
     # add list of starting individuals to the family tree
     todo = args.i if args.i else [fs.get_userid()]
     print(_('Download starting individuals...'))
-    tree.add_indis(todo)
-
-    # download ancestors
-    todo = set(todo)
-    done = set()
-    for i in range(args.a):
-        if not todo:
-            break
-        done |= todo
-        print(_('Download ') + str(i + 1) + _('th generation of ancestors...'))
-        todo = tree.add_parents(todo) - done
-
-    # download descendants
-    todo = set(tree.indi.keys())
-    done = set()
-    for i in range(args.d):
-        if not todo:
-            break
-        done |= todo
-        print(_('Download ') + str(i + 1) + _('th generation of descendants...'))
-        todo = tree.add_children(todo) - done
+    tree.run(tree.add_indis(todo))
+
+    # download ancestors and descendants, each generation as soon as the previous one is known
+    tree.run(tree.crawl(todo, args.a, args.d, print))
+    if checkpoint:
+        checkpoint.phase('crawl')
 
     # download spouses
     if args.m:
         print(_('Download spouses and marriage information...'))
         todo = set(tree.indi.keys())
-        tree.add_spouses(todo)
+        tree.run(tree.add_spouses(todo))
+        if checkpoint:
+            checkpoint.phase('spouses')
 
     # download ordinances, notes and contributors
-    async def download_stuff(loop):
+    async def download_stuff():
         futures = set()
         for fid, indi in tree.indi.items():
-            futures.add(loop.run_in_executor(None, indi.get_notes))
+            futures.add(indi.get_notes())
             if args.c:
-                futures.add(loop.run_in_executor(None, tree.add_ordinances, fid))
+                futures.add(tree.add_ordinances(fid))
             if args.r:
-                futures.add(loop.run_in_executor(None, indi.get_contributors))
+                futures.add(indi.get_contributors())
         for fam in tree.fam.values():
-            futures.add(loop.run_in_executor(None, fam.get_notes))
+            futures.add(fam.get_notes())
             if args.r:
-                futures.add(loop.run_in_executor(None, fam.get_contributors))
-        for future in futures:
-            await future
+                futures.add(fam.get_contributors())
+        await asyncio.gather(*futures)
 
-    loop = asyncio.get_event_loop()
     print(_('Download notes') + (((',' if args.r else _(' and')) + _(' ordinances')) if args.c else '') + (_(' and contributors') if args.r else '') + '...')
-    loop.run_until_complete(download_stuff(loop))
+    tree.run(download_stuff())
+    if checkpoint:
+        checkpoint.phase('notes')
+        checkpoint.close()
 
     # compute number for family relationships and print GEDCOM file
+    fs.close()
+    if cassette:
+        cassette.close()
+    tree.places.save()
     tree.reset_num()
     tree.print(args.o)
     print(_('Downloaded %s individuals, %s families, %s sources and %s notes in %s seconds with %s HTTP requests.') % (str(len(tree.indi)), str(len(tree.fam)), str(len(tree.sources)), str(len(tree.notes)), str(round(time.time() - time_count)), str(fs.counter)))
+    print(_('Sent %s HTTP requests over %s connections.') % fs.connection_stats())
+    if cache:
+        print(_('Read %s responses from the cache.') % cache.hits)
+    if tree.failed:
+        print(_('Could not download %s individuals: %s.') % (len(tree.failed), ', '.join(sorted(tree.failed))))
+    if cassette and cassette.misses:
+        print(_('%s responses were not in %s.') % (cassette.misses, args.replay))
+    if tree.refresh:
+        print(_('Reused %s unchanged individuals and families of %s.') % (len(tree.refresh.reused), args.refresh.name))
+    retries = fs.retry.stats()
+    if retries:
+        print(_('Retried %s requests: %s.') % (sum(retries.values()), ', '.join('%s %s' % item for item in sorted(retries.items()))))
+    if args.metrics_out or args.metrics_prometheus:
+        report = fs.report()
+        if args.metrics_out:
+            json.dump(report, args.metrics_out, indent=2)
+            args.metrics_out.write('\n')
+        if args.metrics_prometheus:
+            args.metrics_prometheus.write(prometheus(report))
@@ -25,8 +25,10 @@ from __future__ import print_function
 
 # global import
 import os
+import gc
 import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 # local import
 from getmyancestors import *
@@ -42,6 +44,35 @@ FACT_TYPES = reversed_dict(FACT_TAGS)
 ORDINANCES = reversed_dict(ORDINANCES_STATUS)
 
 
+BLOCK_SIZE = 2 ** 20  # characters read at once from a GEDCOM file
+
+
+# split the lines of a GEDCOM file into (level, pointer, tag, data), skipping blank lines
+def tokens(file):
+    rest = ''
+    while True:
+        block = file.read(BLOCK_SIZE)
+        lines = (rest + block).split('\n')
+        rest = lines.pop() if block else ''
+        for line in lines:
+            words = line.split(None, 2)
+            if not words:
+                continue
+            if words[1][0] == '@':
+                words = [words[0], words[1]] + (words[2].split(None, 1) if len(words) > 2 else [''])
+                pointer, tag = words[1], words[2]
+                data = words[3] if len(words) > 3 else ''
+            else:
+                pointer, tag = None, words[1]
+                data = words[2] if len(words) > 2 else ''
+            # collapse whitespace like str.split(), every whitespace character but the space is not printable
+            if '  ' in data or data[-1:] == ' ' or not data.isprintable():
+                data = ' '.join(data.split())
+            yield int(words[0]), pointer, tag, data
+        if not block:
+            return
+
+
 class Gedcom:
 
     def __init__(self, file, tree):
@@ -52,115 +83,121 @@ class Gedcom:
         self.pointer = None
         self.tag = None
         self.data = None
-        self.flag = False
         self.indi = dict()
         self.fam = dict()
         self.note = dict()
         self.sour = dict()
-        self.__parse()
+        # start of the crawl which wrote the file, in milliseconds
+        self.started = None
+        self.__tokens = tokens(file)
+        # the parsed objects reference each other: collecting cycles while they are created is only overhead
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self.__parse()
+        finally:
+            if collecting:
+                gc.enable()
         self.__add_id()
 
+    # only the records are sent back by the worker processes of read_files
+    def __getstate__(self):
+        return {'indi': self.indi, 'fam': self.fam, 'note': self.note, 'sour': self.sour}
+
+    # attach records parsed with another tree to this one, as if the file had been parsed with it
+    def join(self, tree):
+        self.tree = tree
+        for indi in self.indi.values():
+            indi.tree = tree
+        for fam in self.fam.values():
+            fam.tree = tree
+        for note in self.note.values():
+            tree.notes.add(note)
+        for num, source in self.sour.items():
+            if source.fid:
+                if source.fid in tree.sources:
+                    tree.sources[source.fid].notes |= source.notes
+                    self.sour[num] = tree.sources[source.fid]
+                else:
+                    tree.sources[source.fid] = source
+        return self
+
+    # move to the next line, the level is -1 at the end of the file
+    def __next(self):
+        self.level, self.pointer, self.tag, self.data = next(self.__tokens, (-1, None, None, None))
+
     def __parse(self):
-        while self.__get_line():
-            if self.tag == 'INDI':
-                self.num = int(self.pointer[2:len(self.pointer) - 1])
-                self.indi[self.num] = Indi(tree=self.tree, num=self.num)
-                self.__get_indi()
-            elif self.tag == 'FAM':
-                self.num = int(self.pointer[2:len(self.pointer) - 1])
-                if self.num not in self.fam:
-                    self.fam[self.num] = Fam(tree=self.tree, num=self.num)
-                self.__get_fam()
-            elif self.tag == 'NOTE':
-                self.num = int(self.pointer[2:len(self.pointer) - 1])
-                if self.num not in self.note:
-                    self.note[self.num] = Note(tree=self.tree, num=self.num)
-                self.__get_note()
-            elif self.tag == 'SOUR':
-                self.num = int(self.pointer[2:len(self.pointer) - 1])
-                if self.num not in self.sour:
-                    self.sour[self.num] = Source(num=self.num)
-                self.__get_source()
+        self.__next()
+        while self.level >= 0:
+            if self.level == 0 and self.tag in self.RECORDS:
+                self.num = int(self.pointer[2:-1])
+                self.RECORDS[self.tag](self)
+            elif self.level == 0 and self.tag == 'HEAD':
+                self.__get_head()
             else:
-                continue
+                self.__next()
 
-    def __get_line(self):
-        # if the flag is set, skip reading a newline
-        if self.flag:
-            self.flag = False
-            return True
-        words = self.f.readline().split()
-
-        if not words:
-            return False
-        self.level = int(words[0])
-        if words[1][0] == '@':
-            self.pointer = words[1]
-            self.tag = words[2]
-            self.data = ' '.join(words[3:])
-        else:
-            self.pointer = None
-            self.tag = words[1]
-            self.data = ' '.join(words[2:])
-        return True
+    def __get_head(self):
+        self.__next()
+        while self.level > 0:
+            if self.level == 1 and self.tag == '_STARTED' and self.data.isdigit():
+                self.started = int(self.data)
+            self.__next()
+
+    # each reader is called on the first line of a structure and leaves the line after it
 
     def __get_indi(self):
-        while self.f and self.__get_line() and self.level > 0:
-            if self.tag == 'NAME':
-                self.__get_name()
-            elif self.tag == 'SEX':
-                self.indi[self.num].gender = self.data
-            elif self.tag in FACT_TYPES or self.tag == 'EVEN':
-                self.indi[self.num].facts.add(self.__get_fact())
-            elif self.tag == 'BAPL':
-                self.indi[self.num].baptism = self.__get_ordinance()
-            elif self.tag == 'CONL':
-                self.indi[self.num].confirmation = self.__get_ordinance()
-            elif self.tag == 'ENDL':
-                self.indi[self.num].endowment = self.__get_ordinance()
-            elif self.tag == 'SLGC':
-                self.indi[self.num].sealing_child = self.__get_ordinance()
-            elif self.tag == 'FAMS':
-                self.indi[self.num].fams_num.add(int(self.data[2:len(self.data) - 1]))
-            elif self.tag == 'FAMC':
-                self.indi[self.num].famc_num.add(int(self.data[2:len(self.data) - 1]))
-            elif self.tag == '_FSFTID':
-                self.indi[self.num].fid = self.data
-            elif self.tag == 'NOTE':
-                num = int(self.data[2:len(self.data) - 1])
-                if num not in self.note:
-                    self.note[num] = Note(tree=self.tree, num=num)
-                self.indi[self.num].notes.add(self.note[num])
-            elif self.tag == 'SOUR':
-                self.indi[self.num].sources.add(self.__get_link_source())
-            elif self.tag == 'OBJE':
-                self.indi[self.num].memories.add(self.__get_memorie())
-        self.flag = True
+        indi = self.indi[self.num] = Indi(tree=self.tree, num=self.num)
+        self.__next()
+        while self.level > 0:
+            read = self.INDI.get(self.tag)
+            if read:
+                read(self, indi)
+            else:
+                self.__next()
 
     def __get_fam(self):
-        while self.__get_line() and self.level > 0:
-            if self.tag == 'HUSB':
-                self.fam[self.num].husb_num = int(self.data[2:len(self.data) - 1])
-            elif self.tag == 'WIFE':
-                self.fam[self.num].wife_num = int(self.data[2:len(self.data) - 1])
-            elif self.tag == 'CHIL':
-                self.fam[self.num].chil_num.add(int(self.data[2:len(self.data) - 1]))
-            elif self.tag in FACT_TYPES:
-                self.fam[self.num].facts.add(self.__get_fact())
-            elif self.tag == 'SLGS':
-                self.fam[self.num].sealing_spouse = self.__get_ordinance()
-            elif self.tag == '_FSFTID':
-                self.fam[self.num].fid = self.data
-            elif self.tag == 'NOTE':
-                num = int(self.data[2:len(self.data) - 1])
-                if num not in self.note:
-                    self.note[num] = Note(tree=self.tree, num=num)
-                self.fam[self.num].notes.add(self.note[num])
-            elif self.tag == 'SOUR':
-                self.fam[self.num].sources.add(self.__get_link_source())
-        self.flag = True
-
-    def __get_name(self):
+        if self.num not in self.fam:
+            self.fam[self.num] = Fam(tree=self.tree, num=self.num)
+        fam = self.fam[self.num]
+        self.__next()
+        while self.level > 0:
+            read = self.FAM.get(self.tag)
+            if read:
+                read(self, fam)
+            else:
+                self.__next()
+
+    def __get_note(self):
+        if self.num not in self.note:
+            self.note[self.num] = Note(tree=self.tree, num=self.num)
+        self.note[self.num].text = self.__get_text()
+
+    def __get_source(self):
+        if self.num not in self.sour:
+            self.sour[self.num] = Source(num=self.num)
+        num = self.num
+        self.__next()
+        while self.level > 0:
+            # the source may be replaced by the one of the same id, hence the lookups
+            if self.tag == 'TITL':
+                self.sour[num].title = self.__get_text()
+            elif self.tag == 'AUTH':
+                self.sour[num].citation = self.__get_text()
+            elif self.tag == 'PUBL':
+                self.sour[num].url = self.__get_text()
+            else:
+                if self.tag == 'REFN':
+                    self.sour[num].fid = self.data
+                    if self.data in self.tree.sources:
+                        self.sour[num] = self.tree.sources[self.data]
+                    else:
+                        self.tree.sources[self.data] = self.sour[num]
+                elif self.tag == 'NOTE':
+                    self.sour[num].notes.add(self.__link_note())
+                self.__next()
+
+    def __get_name(self, indi):
         parts = self.__get_text().split('/')
         name = Name()
         added = False
@@ -168,147 +205,213 @@ class Gedcom:
         name.surname = parts[1].strip()
         if parts[2]:
             name.suffix = parts[2]
-        if not self.indi[self.num].name:
-            self.indi[self.num].name = name
+        if not indi.name:
+            indi.name = name
             added = True
-        while self.__get_line() and self.level > 1:
+        while self.level > 1:
             if self.tag == 'NPFX':
                 name.prefix = self.data
             elif self.tag == 'TYPE':
                 if self.data == 'aka':
-                    self.indi[self.num].aka.add(name)
+                    indi.aka.add(name)
                     added = True
                 elif self.data == 'married':
-                    self.indi[self.num].married.add(name)
+                    indi.married.add(name)
                     added = True
             elif self.tag == 'NICK':
                 nick = Name()
                 nick.given = self.data
-                self.indi[self.num].nicknames.add(nick)
+                indi.nicknames.add(nick)
             elif self.tag == 'NOTE':
-                num = int(self.data[2:len(self.data) - 1])
-                if num not in self.note:
-                    self.note[num] = Note(tree=self.tree, num=num)
-                name.note = self.note[num]
+                name.note = self.__link_note()
+            self.__next()
         if not added:
-            self.indi[self.num].birthnames.add(name)
-        self.flag = True
+            indi.birthnames.add(name)
 
     def __get_fact(self):
         fact = Fact()
         if self.tag != 'EVEN':
             fact.type = FACT_TYPES[self.tag]
             fact.value = self.data
-        while self.__get_line() and self.level > 1:
-            if self.tag == 'TYPE':
-                fact.type = self.data
+        self.__next()
+        while self.level > 1:
             if self.tag == 'DATE':
                 fact.date = self.__get_text()
             elif self.tag == 'PLAC':
                 fact.place = self.__get_text()
             elif self.tag == 'MAP':
                 fact.map = self.__get_map()
-            elif self.tag == 'NOTE':
-                if self.data[:12] == 'Description:':
-                    fact.value = self.data[13:]
-                    continue
-                num = int(self.data[2:len(self.data) - 1])
-                if num not in self.note:
-                    self.note[num] = Note(tree=self.tree, num=num)
-                fact.note = self.note[num]
-            elif self.tag == 'CONT':
-                fact.value += '\n' + self.data
-            elif self.tag == 'CONC':
-                fact.value += self.data
-        self.flag = True
+            else:
+                if self.tag == 'TYPE':
+                    fact.type = self.data
+                elif self.tag == 'NOTE':
+                    if self.data[:12] == 'Description:':
+                        fact.value = self.data[13:]
+                    else:
+                        fact.note = self.__link_note()
+                elif self.tag == 'CONT':
+                    fact.value += '\n' + self.data
+                elif self.tag == 'CONC':
+                    fact.value += self.data
+                self.__next()
         return fact
 
     def __get_map(self):
         latitude = None
         longitude = None
-        while self.__get_line() and self.level > 3:
+        self.__next()
+        while self.level > 3:
             if self.tag == 'LATI':
                 latitude = self.data
             elif self.tag == 'LONG':
                 longitude = self.data
-        self.flag = True
+            self.__next()
         return (latitude, longitude)
 
+    # text of the line with its continuation lines, whatever their level
     def __get_text(self):
         text = self.data
-        while self.__get_line():
-            if self.tag == 'CONT':
-                text += '\n' + self.data
-            elif self.tag == 'CONC':
-                text += self.data
-            else:
-                break
-        self.flag = True
+        self.__next()
+        while self.tag == 'CONT' or self.tag == 'CONC':
+            text += ('\n' if self.tag == 'CONT' else '') + self.data
+            self.__next()
         return text
 
-    def __get_source(self):
-        while self.__get_line() and self.level > 0:
-            if self.tag == 'TITL':
-                self.sour[self.num].title = self.__get_text()
-            elif self.tag == 'AUTH':
-                self.sour[self.num].citation = self.__get_text()
-            elif self.tag == 'PUBL':
-                self.sour[self.num].url = self.__get_text()
-            elif self.tag == 'REFN':
-                self.sour[self.num].fid = self.data
-                if self.data in self.tree.sources:
-                    self.sour[self.num] = self.tree.sources[self.data]
-                else:
-                    self.tree.sources[self.data] = self.sour[self.num]
-            elif self.tag == 'NOTE':
-                num = int(self.data[2:len(self.data) - 1])
-                if num not in self.note:
-                    self.note[num] = Note(tree=self.tree, num=num)
-                self.sour[self.num].notes.add(self.note[num])
-        self.flag = True
-
     def __get_link_source(self):
-        num = int(self.data[2:len(self.data) - 1])
+        num = int(self.data[2:-1])
         if num not in self.sour:
             self.sour[num] = Source(num=num)
         page = None
-        while self.__get_line() and self.level > 1:
+        self.__next()
+        while self.level > 1:
             if self.tag == 'PAGE':
                 page = self.__get_text()
-        self.flag = True
+            else:
+                self.__next()
         return (self.sour[num], page)
 
     def __get_memorie(self):
         memorie = Memorie()
-        while self.__get_line() and self.level > 1:
+        self.__next()
+        while self.level > 1:
             if self.tag == 'TITL':
                 memorie.description = self.__get_text()
             elif self.tag == 'FILE':
                 memorie.url = self.__get_text()
-        self.flag = True
+            else:
+                self.__next()
         return memorie
 
-    def __get_note(self):
-        self.note[self.num].text = self.__get_text()
-        self.flag = True
-
     def __get_ordinance(self):
         ordinance = Ordinance()
-        while self.__get_line() and self.level > 1:
+        self.__next()
+        while self.level > 1:
             if self.tag == 'DATE':
                 ordinance.date = self.__get_text()
-            elif self.tag == 'TEMP':
-                ordinance.temple_code = self.data
-            elif self.tag == 'STAT':
-                ordinance.status = ORDINANCES[self.data]
-            elif self.tag == 'FAMC':
-                num = int(self.data[2:len(self.data) - 1])
-                if num not in self.fam:
-                    self.fam[num] = Fam(tree=self.tree, num=num)
-                ordinance.famc = self.fam[num]
-        self.flag = True
+            else:
+                if self.tag == 'TEMP':
+                    ordinance.temple_code = self.data
+                elif self.tag == 'STAT':
+                    ordinance.status = ORDINANCES[self.data]
+                elif self.tag == 'FAMC':
+                    num = int(self.data[2:-1])
+                    if num not in self.fam:
+                        self.fam[num] = Fam(tree=self.tree, num=num)
+                    ordinance.famc = self.fam[num]
+                self.__next()
         return ordinance
 
+    # note of a NOTE link on the current line
+    def __link_note(self):
+        num = int(self.data[2:-1])
+        if num not in self.note:
+            self.note[num] = Note(tree=self.tree, num=num)
+        return self.note[num]
+
+    # readers of the lines of an individual
+
+    def __indi_name(self, indi):
+        self.__get_name(indi)
+
+    def __indi_sex(self, indi):
+        indi.gender = self.data
+        self.__next()
+
+    def __indi_fact(self, indi):
+        indi.facts.add(self.__get_fact())
+
+    def __indi_baptism(self, indi):
+        indi.baptism = self.__get_ordinance()
+
+    def __indi_confirmation(self, indi):
+        indi.confirmation = self.__get_ordinance()
+
+    def __indi_endowment(self, indi):
+        indi.endowment = self.__get_ordinance()
+
+    def __indi_sealing(self, indi):
+        indi.sealing_child = self.__get_ordinance()
+
+    def __indi_fams(self, indi):
+        indi.fams_num.add(int(self.data[2:-1]))
+        self.__next()
+
+    def __indi_famc(self, indi):
+        indi.famc_num.add(int(self.data[2:-1]))
+        self.__next()
+
+    def __indi_fid(self, indi):
+        indi.fid = self.data
+        self.__next()
+
+    def __indi_note(self, indi):
+        indi.notes.add(self.__link_note())
+        self.__next()
+
+    def __indi_source(self, indi):
+        indi.sources.add(self.__get_link_source())
+
+    def __indi_memorie(self, indi):
+        indi.memories.add(self.__get_memorie())
+
+    # readers of the lines of a family
+
+    def __fam_husb(self, fam):
+        fam.husb_num = int(self.data[2:-1])
+        self.__next()
+
+    def __fam_wife(self, fam):
+        fam.wife_num = int(self.data[2:-1])
+        self.__next()
+
+    def __fam_chil(self, fam):
+        fam.chil_num.add(int(self.data[2:-1]))
+        self.__next()
+
+    def __fam_fact(self, fam):
+        fam.facts.add(self.__get_fact())
+
+    def __fam_sealing(self, fam):
+        fam.sealing_spouse = self.__get_ordinance()
+
+    def __fam_fid(self, fam):
+        fam.fid = self.data
+        self.__next()
+
+    def __fam_note(self, fam):
+        fam.notes.add(self.__link_note())
+        self.__next()
+
+    def __fam_source(self, fam):
+        fam.sources.add(self.__get_link_source())
+
+    RECORDS = {'INDI': __get_indi, 'FAM': __get_fam, 'NOTE': __get_note, 'SOUR': __get_source}
+    INDI = dict(dict.fromkeys(list(FACT_TYPES) + ['EVEN'], __indi_fact), NAME=__indi_name, SEX=__indi_sex,
+                BAPL=__indi_baptism, CONL=__indi_confirmation, ENDL=__indi_endowment, SLGC=__indi_sealing,
+                FAMS=__indi_fams, FAMC=__indi_famc, _FSFTID=__indi_fid, NOTE=__indi_note, SOUR=__indi_source, OBJE=__indi_memorie)
+    FAM = dict(dict.fromkeys(FACT_TYPES, __fam_fact), HUSB=__fam_husb, WIFE=__fam_wife, CHIL=__fam_chil,
+               SLGS=__fam_sealing, _FSFTID=__fam_fid, NOTE=__fam_note, SOUR=__fam_source)
+
     def __add_id(self):
         for num in self.fam:
             if self.fam[num].husb_num:
@@ -324,11 +427,36 @@ class Gedcom:
                 self.indi[num].fams_fid.add((self.fam[fams].husb_fid, self.fam[fams].wife_fid))
 
 
+# parse a GEDCOM file in a worker process of read_files
+def read_file(filename):
+    with open(filename, encoding='utf-8') as file:
+        ged = Gedcom(file, Tree())
+    # the worker tree is not sent back with the records
+    for indi in ged.indi.values():
+        indi.tree = None
+    for fam in ged.fam.values():
+        fam.tree = None
+    return ged
+
+
+# parse GEDCOM files with tree and yield them in order, several files are parsed at once in processes
+def read_files(files, tree, processes=None):
+    processes = min(processes or os.cpu_count() or 1, len(files))
+    if processes < 2 or not all(os.path.isfile(file.name) for file in files):
+        for file in files:
+            yield Gedcom(file, tree)
+        return
+    with ProcessPoolExecutor(processes) as executor:
+        for ged in executor.map(read_file, [file.name for file in files]):
+            yield ged.join(tree)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Merge GEDCOM data from FamilySearch Tree (4 Jul 2016)', add_help=False, usage='mergemyancestors.py -i input1.ged input2.ged ... [options]')
     try:
         parser.add_argument('-i', metavar='<FILE>', nargs='+', type=argparse.FileType('r', encoding='UTF-8'), default=sys.stdin, help='input GEDCOM files [stdin]')
         parser.add_argument('-o', metavar='<FILE>', nargs='?', type=argparse.FileType('w', encoding='UTF-8'), default=sys.stdout, help='output GEDCOM files [stdout]')
+        parser.add_argument('--processes', metavar='<INT>', type=int, help='Number of input files parsed at once [number of CPUs]')
     except TypeError:
         sys.stderr.write('Python >= 3.4 is required to run this script\n')
         sys.stderr.write('(see https://docs.python.org/3/whatsnew/3.4.html#argparse)\n')
@@ -344,19 +472,14 @@ if __name__ == '__main__':
 
     tree = Tree()
 
-    indi_counter = 0
-    fam_counter = 0
-
     # read the GEDCOM data
-    for file in args.i:
-        ged = Gedcom(file, tree)
+    for ged in read_files(args.i if isinstance(args.i, list) else [args.i], tree, args.processes):
 
         # add informations about individuals
         for num in ged.indi:
             fid = ged.indi[num].fid
             if fid not in tree.indi:
-                indi_counter += 1
-                tree.indi[fid] = Indi(tree=tree, num=indi_counter)
+                tree.indi[fid] = Indi(tree=tree)
                 tree.indi[fid].tree = tree
                 tree.indi[fid].fid = ged.indi[num].fid
             tree.indi[fid].fams_fid |= ged.indi[num].fams_fid
@@ -381,8 +504,7 @@ if __name__ == '__main__':
         for num in ged.fam:
             husb, wife = (ged.fam[num].husb_fid, ged.fam[num].wife_fid)
             if (husb, wife) not in tree.fam:
-                fam_counter += 1
-                tree.fam[(husb, wife)] = Fam(husb, wife, tree, fam_counter)
+                tree.fam[(husb, wife)] = Fam(husb, wife, tree)
                 tree.fam[(husb, wife)].tree = tree
             tree.fam[(husb, wife)].chil_fid |= ged.fam[num].chil_fid
             if ged.fam[num].fid:
@@ -395,17 +517,6 @@ if __name__ == '__main__':
                 tree.fam[(husb, wife)].sources = ged.fam[num].sources
             tree.fam[(husb, wife)].sealing_spouse = ged.fam[num].sealing_spouse
 
-    # merge notes by text
-    tree.notes = sorted(tree.notes, key=lambda x: x.text)
-    for i, n in enumerate(tree.notes):
-        if i == 0:
-            n.num = 1
-            continue
-        if n.text == tree.notes[i - 1].text:
-            n.num = tree.notes[i - 1].num
-        else:
-            n.num = tree.notes[i - 1].num + 1
-
-    # compute number for family relationships and print GEDCOM file
+    # number the records and print GEDCOM file
     tree.reset_num()
     tree.print(args.o)